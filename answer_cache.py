@@ -0,0 +1,132 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.environ.get(
+    "ANSWER_CACHE_PATH", os.path.join("cache", "answers.sqlite3"))
+MAX_BYTES = int(os.environ.get("ANSWER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+TTL = float(os.environ.get("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+BYPASS = os.environ.get("ANSWER_CACHE_BYPASS", "false").lower() in ("1", "true", "yes")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    report_hash TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answers_by_last_used ON answers (last_used);
+"""
+
+
+def normalize_prompt(prompt):
+    """Folds case, whitespace and trailing punctuation that do not change the question."""
+    prompt = re.sub(r'\s+', ' ', prompt).strip().casefold()
+    return prompt.rstrip(' .?!')
+
+
+def model_fingerprint(model_name, generation_config, system_instruction, tools=None):
+    config = [model_name, generation_config, system_instruction]
+    # Models without tools keep the fingerprint they had before tools counted.
+    if tools is not None:
+        config.append(tools)
+    payload = json.dumps(config, sort_keys=True, default=repr)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def answer_key(report_hash, prompt, fingerprint):
+    payload = json.dumps([report_hash, normalize_prompt(prompt), fingerprint])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class AnswerCache:
+    """Persistent cache of model answers to stateless questions about a report.
+
+    Only questions answered from the report alone (no prior chat turns) are
+    cached, since their answer depends on nothing but the report, the prompt
+    and the model configuration.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_BYTES, ttl=TTL, bypass=BYPASS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def get(self, key):
+        if self.bypass:
+            return None
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT answer, expires_at FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] <= now:
+                self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+                self.evictions += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, report_hash, prompt, answer):
+        if self.bypass or not answer:
+            return
+        now = time.time()
+        size = len(answer.encode('utf-8'))
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, report_hash, prompt, answer, size, now, now, now + self.ttl))
+            self._evict(now)
+
+    def _evict(self, now):
+        expired = self._conn.execute("DELETE FROM answers WHERE expires_at <= ?", (now,))
+        self.evictions += expired.rowcount
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Least recently used first until we are back under the budget.
+        for key, size in self._conn.execute(
+                "SELECT key, size FROM answers ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+            'bypass': self.bypass,
+        }
+
+
+answer_cache = AnswerCache()
@@ -1,11 +1,14 @@
-import os
-import time
 import logging
-from dotenv import load_dotenv
-import google.generativeai as genai
 import chainlit as cl
 from chainlit.logger import logger as l
 import asyncio
+from model_client import client
+from models import get_model
+from upload_cache import upload_cache, file_sha256
+from file_readiness import wait_for_files_active, FileWaitStopped
+from scheduler import scheduler
+import router
+from metrics import span, log_response, start_metrics_server
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -14,63 +17,23 @@ logger = logging.getLogger(__name__)
 # Set Chainlit logger to ERROR level to suppress warnings
 l.setLevel(logging.ERROR)
 
-load_dotenv()
-genai.configure(api_key=os.environ["GEMINI_API_KEY"])
 # flag = False
 
 def upload_to_gemini(path, mime_type=None):
     try:
-        file = genai.upload_file(path, mime_type=mime_type)
+        file = client.upload_file(path, mime_type=mime_type)
         logger.info(f"Uploaded file '{file.display_name}' as: {file.uri}")
         return file
     except Exception as e:
         logger.error(f"Error uploading file: {str(e)}")
         raise
 
-def wait_for_files_active(files):
-    logger.info("Waiting for file processing...")
-    for name in (file.name for file in files):
-        file = genai.get_file(name)
-        while file.state.name == "PROCESSING":
-            logger.info(".", end="", flush=True)
-            time.sleep(1)
-            file = genai.get_file(name)
-        if file.state.name != "ACTIVE":
-            raise Exception(f"File {file.name} failed to process")
-    logger.info("...all files ready")
-
-generation_config = {
-    "temperature": 0.1,
-    "top_p": 0.95,
-    "top_k": 64,
-    "max_output_tokens": 100000,
-    "response_mime_type": "text/plain",
-}
-
-model = genai.GenerativeModel(
-    model_name="gemini-1.5-pro-exp-0827",
-    generation_config=generation_config,
-    system_instruction='''
-    You’re a highly skilled cybersecurity analyst with a deep understanding of unstructured data analysis and natural language processing. You have been working in the field for over 15 years, specializing in interpreting and synthesizing complex cybersecurity audit reports into clear, actionable insights. Your expertise allows you to facilitate effective communication on cybersecurity issues through intuitive, chat-based interaction.
-
-    Your task is to analyze unstructured cybersecurity audit reports attached and provide chat-based responses to decision-related questions. Here are the details you need to keep in mind:  
-    - Unstructured audit report content
-    - Specific questions or decision points to address
-    - Key metrics or insights to highlight
-    - Audience for the chat-based output
-
-    Remember, your goal is to leverage machine learning algorithms and NLP capabilities to not only interpret the reports but also to summarize findings and present actionable insights that streamline the decision-making process efficiently. Always remember to format the text in the type requested by the user like: Bulletted List, Table or Tabular, csv, json, etc.
-    
-    Take a deep breath and answer the query, thinking it through step-by-step.
-    ''',
-    tools='code_execution',
-)
-
 
 @cl.on_chat_start
 async def start():
+    start_metrics_server()
     logger.info("Chat started")
-    cl.user_session.set("chat_session", model.start_chat(history=[]))
+    cl.user_session.set("chat_session", client.start_chat(get_model()))
     await cl.Message(content="Welcome! Please upload an audit report (pdf) to begin.").send()
 
 
@@ -79,37 +42,68 @@ async def main(message: cl.Message):
     # global flag
     logger.info(f"Received message: {message.content}")
     chat_session = cl.user_session.get("chat_session")
+    session_id = cl.user_session.get("id")
+    # Set by on_stop so a pending file-readiness wait can bail out early.
+    cl.user_session.set("stop_event", asyncio.Event())
 
     try:
         if message.elements:
             files = []
+            uploaded = []
             for element in message.elements:
                 if isinstance(element, cl.File) and element.mime == "application/pdf":
-                    files.append(upload_to_gemini(element.path, element.mime))
+                    with span("upload", session_id) as attributes:
+                        # Hashing, cache checks and uploads block, keep them
+                        # off the event loop so other sessions aren't stalled.
+                        digest = await asyncio.to_thread(file_sha256, element.path)
+                        file = await scheduler.run_with_retry(session_id, upload_cache.lookup, digest)
+                        attributes['cached'] = file is not None
+                        if file is None:
+                            file = await scheduler.run_with_retry(
+                                session_id, upload_to_gemini, element.path, element.mime)
+                            uploaded.append((digest, file))
+                    files.append(file)
 
             if not files:
                 await cl.Message(content="No valid PDF files were uploaded. Please upload a PDF file.").send()
                 return
 
-            wait_for_files_active(files)
+            # Cache hits are already ACTIVE, only fresh uploads need to wait.
+            if uploaded:
+                with span("readiness_wait", session_id, files=len(uploaded)):
+                    await wait_for_files_active(
+                        [file for _, file in uploaded],
+                        stop_event=cl.user_session.get("stop_event"),
+                        session_id=session_id)
+                for digest, file in uploaded:
+                    upload_cache.store(digest, file)
+            logger.info(f"Upload cache stats: {upload_cache.stats()}")
 
             logger.info("Sending message to Gemini with uploaded file")
-            response = chat_session.send_message([
+            content = [
                 files[0],
                 message.content # "Summarize the priority issues in this audit report and grade them by severity and order by which should be fixed first.",
-            ])
+            ]
         else:
             if not chat_session:
                 await cl.Message(content="Please upload a PDF file to analyze first.").send()
                 return
 
             logger.info("Sending message to Gemini")
-            response = chat_session.send_message(message.content)
-
-        logger.info(f"Received response from Gemini: {response.text}")
-        await cl.Message(content=response.text).send()
+            content = message.content
+
+        route = router.classify(message.content, new_report=bool(message.elements))
+        reply = cl.Message(content="")
+        with span("model_call", session_id, tier=route.tier, reason=route.reason):
+            response_text = await router.send(chat_session, content, route, reply, session_id)
+        with span("ui_send", session_id):
+            await reply.send()
+        log_response(logger, response_text)
             
 
+    except FileWaitStopped as e:
+        logger.info(str(e))
+        await cl.Message(content="Stopped waiting for the report to finish processing.").send()
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
         await cl.Message(content=f"An error occurred: {str(e)}").send()
@@ -119,5 +113,7 @@ async def main(message: cl.Message):
 
 @cl.on_stop
 def on_stop():
+    stop_event = cl.user_session.get("stop_event")
+    if stop_event:
+        stop_event.set()
     logger.info("Chat stopped")
-    
\ No newline at end of file
@@ -1,16 +1,44 @@
 import os
 import json
-import time
 import logging
-from dotenv import load_dotenv
 import google.generativeai as genai
 import chainlit as cl
 from chainlit.logger import logger as l
 from chainlit.types import ThreadDict
+import time
 import asyncio
+import functools
+from model_client import client
+import models
+from upload_cache import upload_cache, file_sha256
+from file_readiness import wait_for_files_active, FileWaitStopped
+import router
+from scheduler import scheduler, ServiceOverloaded, is_transient
+import history_log
+from session_catalog import catalog
+from answer_cache import answer_cache, answer_key, model_fingerprint
+import report_index
+import mapreduce
+import findings
+import report_digest
+import context_window
 import uuid
-
-chat_sessions = {}
+from session_store import SessionStore
+from metrics import registry, span, log_response, start_metrics_server
+from singleflight import SingleFlight, WaitStopped
+
+chat_sessions = SessionStore()
+background_tasks = set()
+# Identical work already in flight in another session is joined, not repeated.
+uploads = SingleFlight("upload")
+questions = SingleFlight("question")
+
+registry.gauge("cyberinsight_scheduler_queue_depth",
+               "Model API calls waiting for a scheduler slot.",
+               lambda: scheduler.queue_depth)
+registry.gauge("cyberinsight_resident_sessions",
+               "Chat sessions currently held in memory.",
+               lambda: chat_sessions.stats()['resident'])
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -19,10 +47,12 @@ logger = logging.getLogger(__name__)
 # Set Chainlit logger to ERROR level to suppress warnings
 l.setLevel(logging.ERROR)
 
-load_dotenv()
-genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+# The API key is read and the model built on first use, see models.py
 # flag = False
 
+# Turns shown when a chat is resumed; older ones are loaded on request.
+HISTORY_PAGE_TURNS = int(os.environ.get("HISTORY_PAGE_TURNS", "20"))
+
 
 def convert_history_to_serializable(history):
     serializable_history = []
@@ -42,204 +72,578 @@ def convert_history_to_serializable(history):
 
 
 def save_conversation_history(session_id, history):
-    folder = 'chat_histories'
-    if not os.path.exists(folder):
-        os.makedirs(folder)  # Create folder if it doesn't exist
-    file_path = os.path.join(folder, f'conversation_{session_id}.json')
     serializable_history = convert_history_to_serializable(history)
-    with open(file_path, 'w') as file:
-        json.dump(serializable_history, file)
-    return file_path
+    history_log.write_entries(session_id, serializable_history)
+    return history_log.log_path(session_id)
+
+
+def load_conversation_history(session_id, tail=None):
+    return history_log.read_entries(session_id, tail=tail)
+
+
+async def append_to_history(session_id, user_message, model_response, files=None):
+    user_entry = {'role': 'user', 'parts': [user_message]}
+    if files:
+        # Remember which reports the turn was about so an evicted or resumed
+        # session can re-attach them.
+        user_entry['files'] = files
+    await asyncio.to_thread(history_log.append_entries, session_id, [
+        user_entry,
+        {'role': 'model', 'parts': [model_response]},
+    ])
+    report = files[0] if files else {}
+    await asyncio.to_thread(catalog.record_turn, session_id, user_message,
+                            report.get('display_name'), report.get('digest'))
+
+
+def report_reference(display_name):
+    return (f"[The report '{display_name}' was attached here. Relevant excerpts "
+            f"from it are included with later questions.]")
+
+
+def is_report_part(part):
+    """Report parts are pinned in the history and never summarized away."""
+    if isinstance(part, str):
+        return part.startswith("[The report '")
+    return 'file_data' in part or part.text.startswith("[The report '")
+
+
+def detach_reports(chat_session, display_names, question=None):
+    """Replaces PDF parts in the chat history with a short text reference.
+
+    `display_names` maps the URI of each indexed report file to its name;
+    other files stay attached. With `question`, the last user turn is also
+    cut back to the bare question, dropping the report excerpts that were
+    sent with it.
+    """
+    history = []
+    for content in chat_session.history:
+        parts = [report_reference(display_names[part.file_data.file_uri])
+                 if 'file_data' in part and part.file_data.file_uri in display_names else part
+                 for part in content.parts]
+        history.append({'role': content.role, 'parts': parts})
+    if question is not None and len(history) >= 2:
+        history[-2]['parts'] = [question]
+    chat_session.history = history
+
+
+async def report_parts(session_id, refs):
+    """Turns saved report refs back into parts: a text reference if the
+    report is indexed locally, else the uploaded file if it still exists."""
+    parts = []
+    for ref in refs:
+        if report_index.retrieval_enabled() and report_index.load(ref['digest']):
+            parts.append(report_reference(ref['display_name']))
+            continue
+        file = await scheduler.run_with_retry(session_id, upload_cache.lookup, ref['digest'])
+        if file is None:
+            logger.warning(f"Report {ref['display_name']} is no longer available for session {session_id}")
+            continue
+        parts.append(file)
+    return parts
 
 
-def load_conversation_history(session_id):
-    file_path = os.path.join(
-        'chat_histories', f'conversation_{session_id}.json')
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as file:
-            return json.load(file)
-    return []
-
-
-async def append_to_history(session_id, user_message, model_response):
-    history = load_conversation_history(session_id)
-    history.append({'role': 'user', 'parts': [user_message]})
-    history.append({'role': 'model', 'parts': [model_response]})
-    save_conversation_history(session_id, history)
+async def initialize_chat(session_id):
+    with span("history_load", session_id) as attributes:
+        # Turns already folded into the context summary are not replayed.
+        summary = await asyncio.to_thread(context_window.load_summary, session_id)
+        start = summary['covered'] if summary else 0
+        history = await asyncio.to_thread(history_log.read_entries, session_id, start=start)
+        attributes['entries'] = len(history)
+        attributes['summarized'] = start
+        converted_history = []
+        if summary:
+            pinned = await report_parts(session_id, summary['files'])
+            converted_history.extend(context_window.summary_preamble(pinned, summary['summary']))
+        for item in history:
+            parts = await report_parts(session_id, item.get('files', []))
+            parts.extend(part if isinstance(part, str) else part['text']
+                         for part in item['parts'])
+            converted_item = genai.types.ContentDict(
+                role=item['role'],
+                parts=parts
+            )
+            converted_history.append(converted_item)
+        return client.start_chat(models.get_model(), converted_history)
+
+
+async def compact_context(session_id, chat_session):
+    """Folds old turns into the rolling summary once over the token budget."""
+    contents = list(chat_session.history)
+    try:
+        result = await scheduler.run(session_id, context_window.compact, session_id, contents,
+                                     models.get_model().model_name, is_report_part)
+    except Exception as e:
+        logger.warning(f"Context summary failed for session {session_id}: {str(e)}")
+        return
+    if result is None:
+        return
+    history, summary = result
+    # Only swap the history in if no turn started or finished meanwhile;
+    # otherwise the next turn tries again.
+    if chat_session.last is not None or len(chat_session.history) != len(contents):
+        logger.info(f"Session {session_id} moved on while summarizing, keeping its history")
+        return
+    await asyncio.to_thread(context_window.save_summary, session_id, summary)
+    chat_session.history = history
+    chat_sessions.touch(session_id)
+
+
+async def extract_report_findings(session_id, digest, file, display_name):
+    try:
+        await scheduler.run(session_id, findings.extract_findings, digest, file, models.get_model().model_name)
+    except Exception as e:
+        logger.warning(f"Findings extraction failed for report {digest[:12]}: {str(e)}")
+        return
+    # Cheap and local; kept up to date here so comparisons never wait on it.
+    await asyncio.to_thread(report_digest.ensure_digest, digest, display_name)
 
 
-async def initialize_chat(session_id):
-    history = load_conversation_history(session_id)
-    converted_history = []
-    for item in history:
-        converted_item = genai.types.ContentDict(
-            role=item['role'],
-            parts=[part if isinstance(part, str) else part['text']
-                   for part in item['parts']]
-        )
-        converted_history.append(converted_item)
-    return model.start_chat(history=converted_history)
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
 
-def list_previous_chats():
-    folder = 'chat_histories'
-    if os.path.exists(folder):
-        return [f.split('_')[1].split('.')[0] for f in os.listdir(folder) if f.endswith('.json')]
-    return []
+def list_previous_chats(limit=20, offset=0, report_hash=None):
+    return catalog.recent(limit=limit, offset=offset, report_hash=report_hash)
 
 
 def upload_to_gemini(path, mime_type=None):
     try:
-        file = genai.upload_file(path, mime_type=mime_type)
+        file = client.upload_file(path, mime_type=mime_type)
         logger.info(f"Uploaded file '{file.display_name}' as: {file.uri}")
         return file
     except Exception as e:
-        logger.error(f"Error uploading file: {str(e)}")
+        # Transient failures are retried by the scheduler, see run_with_retry.
+        logger.warning(f"Error uploading file: {str(e)}")
         raise
 
 
-def wait_for_files_active(files):
-    logger.info("Waiting for file processing...")
-    for name in (file.name for file in files):
-        file = genai.get_file(name)
-        while file.state.name == "PROCESSING":
-            logger.info(".", end="", flush=True)
-            time.sleep(1)
-            file = genai.get_file(name)
-        if file.state.name != "ACTIVE":
-            raise Exception(f"File {file.name} failed to process")
-    logger.info("...all files ready")
-
-
-generation_config = {
-    "temperature": 0.1,
-    "top_p": 0.95,
-    "top_k": 64,
-    "max_output_tokens": 100000,
-    "response_mime_type": "text/plain",
-}
-
-model = genai.GenerativeModel(
-    model_name="gemini-1.5-pro-exp-0827",
-    generation_config=generation_config,
-    system_instruction='''
-    You’re a highly skilled cybersecurity analyst with a deep understanding of unstructured data analysis and natural language processing. You have been working in the field for over 15 years, specializing in interpreting and synthesizing complex cybersecurity audit reports into clear, actionable insights. Your expertise allows you to facilitate effective communication on cybersecurity issues through intuitive, chat-based interaction.
-
-    Your task is to analyze unstructured cybersecurity audit reports attached and provide chat-based responses to decision-related questions. Here are the details you need to keep in mind:  
-    - Unstructured audit report content
-    - Specific questions or decision points to address
-    - Key metrics or insights to highlight
-    - Audience for the chat-based output
-
-    Remember, your goal is to leverage machine learning algorithms and NLP capabilities to not only interpret the reports but also to summarize findings and present actionable insights that streamline the decision-making process efficiently. Always remember to format the text in the type requested by the user like: Bulletted List, Table or Tabular, csv, json, etc.
-    
-    Take a deep breath and answer the query, thinking it through step-by-step.
-    ''',
-    tools='code_execution',
-)
+async def prepare_report(session_id, path, mime_type, digest):
+    """Returns an ACTIVE uploaded file for the report, uploading it and
+    waiting for processing unless the upload cache already has one."""
+    with span("upload", session_id) as attributes:
+        file = await scheduler.run_with_retry(session_id, upload_cache.lookup, digest)
+        attributes['cached'] = file is not None
+        if file is not None:
+            return file
+        file = await scheduler.run_with_retry(session_id, upload_to_gemini, path, mime_type)
+    # No stop_event here: the wait may be shared with other sessions, each
+    # of which stops only its own wait (see SingleFlight.do).
+    with span("readiness_wait", session_id):
+        [file] = await wait_for_files_active([file], session_id=session_id)
+    upload_cache.store(digest, file)
+    return file
+
+
+class StopAwareReply:
+    """Streams into `message` until `stop_event` is set, for answers that
+    may outlive the session that started them."""
+
+    def __init__(self, message, stop_event):
+        self.message = message
+        self.stop_event = stop_event
+
+    @property
+    def content(self):
+        return self.message.content
+
+    @content.setter
+    def content(self, value):
+        self.message.content = value
+
+    async def stream_token(self, token, is_sequence=False):
+        if not self.stop_event.is_set():
+            await self.message.stream_token(token, is_sequence=is_sequence)
+
+
+async def analyze_shards(session_id, chat_session, reports, question, route, reply):
+    """Answers a question about a large or multi-file upload by map-reduce
+    over page-range shards, reporting progress in its own message.
+
+    `reports` are (report, index) pairs. Returns (text, complete), where
+    complete is False if some shards failed and the answer is partial.
+    """
+    shards = mapreduce.plan_shards([(report['display_name'], index) for report, index in reports])
+    started = time.monotonic()
+    progress = cl.Message(content=f"Analyzing {len(reports)} report(s) in {len(shards)} sections…")
+    await progress.send()
+
+    async def on_progress(done, total, cached, failed):
+        progress.content = (f"Analyzed {done} of {total} sections "
+                            f"({cached} from an earlier run, {failed} failed)…")
+        await progress.update()
+
+    with span("map", session_id, shards=len(shards)) as attributes:
+        results, failed = await mapreduce.run_map(
+            shards, question, models.get_model().model_name, session_id, on_progress)
+        attributes['failed'] = len(failed)
+    if not results:
+        raise RuntimeError("None of the report sections could be analyzed, please try again.")
+    progress.content = (f"Analyzed {len(results)} of {len(shards)} sections of {len(reports)} "
+                        f"report(s) in {time.monotonic() - started:.0f}s.")
+    if failed:
+        progress.content += (f" Could not analyze {'; '.join(shard.label for shard in failed)}. "
+                             f"Ask again to retry only those sections.")
+    await progress.update()
+
+    text = await router.send(chat_session, mapreduce.reduce_prompt(question, results, failed),
+                             route, reply, session_id)
+    # Keep the merged findings out of the history resent on later turns.
+    history = list(chat_session.history)
+    history[-2] = {'role': 'user', 'parts': [report_reference(report['display_name'])
+                                             for report, _ in reports] + [question]}
+    chat_session.history = history
+    return text, not failed
+
+
+# Cached answers are only valid for the model configuration that produced them
+MODEL_FINGERPRINT = model_fingerprint(
+    models.qualified_name(), models.GENERATION_CONFIG, models.SYSTEM_INSTRUCTION,
+    models.spec().get('tools'))
+
+
+def entry_text(entry):
+    return '\n\n'.join(part if isinstance(part, str) else part.get('text', '')
+                       for part in entry['parts'])
+
+
+def earlier_turns_action(stop):
+    return cl.Action(name="load_earlier", payload={'stop': stop}, label="Show earlier messages")
+
+
+async def replay_history(session_id):
+    """Shows the latest HISTORY_PAGE_TURNS turns of the saved conversation
+    as one message.
+
+    Only that page of the log is read. If there is more, a button on it
+    loads the page before (see `load_earlier`).
+    """
+    with span("history_replay", session_id) as attributes:
+        stop = await asyncio.to_thread(history_log.entry_count, session_id)
+        start = max(stop - HISTORY_PAGE_TURNS * 2, 0)
+        entries = await asyncio.to_thread(history_log.read_entries, session_id, start=start, stop=stop)
+        attributes['entries'] = len(entries)
+        if entries:
+            await send_turns(entries, start, stop, "Conversation so far")
+
+
+async def send_turns(entries, start, stop, heading):
+    lines = [f"**{heading} ({start // 2 + 1}-{stop // 2} of this conversation)**"]
+    for entry in entries:
+        speaker = "You" if entry['role'] == 'user' else "Assistant"
+        lines.append(f"**{speaker}:** {entry_text(entry)}")
+    await cl.Message(content='\n\n'.join(lines),
+                     actions=[earlier_turns_action(start)] if start else []).send()
+
+
+@cl.action_callback("load_earlier")
+async def load_earlier(action: cl.Action):
+    """Shows the page of turns before `action.payload['stop']` as one message."""
+    session_id = cl.user_session.get("session_id")
+    stop = int(action.payload['stop'])
+    start = max(stop - HISTORY_PAGE_TURNS * 2, 0)
+    await action.remove()
+    entries = await asyncio.to_thread(history_log.read_entries, session_id, start=start, stop=stop)
+    await send_turns(entries, start, stop, "Earlier messages")
 
 
 @cl.on_chat_start
 async def start():
+    start_metrics_server()
     session_id = str(uuid.uuid4())
+    # Chainlit saves the user session as the thread's metadata, which is
+    # how on_chat_resume finds this id again.
+    cl.user_session.set("session_id", session_id)
     chat_session = await initialize_chat(session_id)
-    chat_sessions[session_id] = chat_session
+    chat_sessions.put(session_id, chat_session)
     logger.info(f"Chat started with session id as: {session_id}")
 
-    cl.user_session.set("session_id", session_id)
-    cl.user_session.set("chat_session", chat_session)
-
-    # Load and display previous messages
-    history = load_conversation_history(session_id)
-    for item in history:
-        if item['role'] == 'user':
-            await cl.Message(content=item['parts'][0], author="Human").send()
-        elif item['role'] == 'model':
-            await cl.Message(content=item['parts'][0]).send()
-
     await cl.Message(content="Welcome! Please upload an audit report (pdf) to begin.").send()
 
 
 @cl.on_message
 async def main(message: cl.Message):
     session_id = cl.user_session.get("session_id")
-    chat_session = chat_sessions.get(session_id)
+    # Evicted sessions are rebuilt from their saved history on demand
+    chat_session = await chat_sessions.get_or_load(session_id, initialize_chat)
     logger.info(f"Continuing conversation with session id: {session_id}")
 
     logger.info(f"Received message: {message.content}")
-
+    # Set by on_stop so a pending file-readiness wait can bail out early.
+    cl.user_session.set("stop_event", asyncio.Event())
+
+    cache_key = None
+    cached_text = None
+    indexes = []
+    searchable = []
+    detached = {}
+    sharded = False
+    complete = True
+    excerpts_sent = False
+    local_answer = None
     try:
         if message.elements:
-            files = []
-            for element in message.elements:
-                if isinstance(element, cl.File) and element.mime == "application/pdf":
-                    files.append(upload_to_gemini(element.path, element.mime))
-
-            if not files:
+            elements = [element for element in message.elements
+                        if isinstance(element, cl.File) and element.mime == "application/pdf"]
+            if not elements:
                 await cl.Message(content="No valid PDF files were uploaded. Please upload a PDF file.").send()
                 return
-
-            wait_for_files_active(files)
-
-            logger.info("Sending message to Gemini with uploaded file")
-            response = chat_session.send_message([
-                files[0],
+            paths = [element.path for element in elements]
+            names = [element.name for element in elements]
+            digests = await asyncio.gather(*(asyncio.to_thread(file_sha256, path) for path in paths))
+
+            # Sessions attaching the same report at the same time share one
+            # upload and one readiness wait.
+            stop_event = cl.user_session.get("stop_event")
+            results = await asyncio.gather(*(
+                uploads.do(digest, functools.partial(prepare_report, session_id, path, element.mime, digest),
+                           stop_event=stop_event)
+                for element, path, digest in zip(elements, paths, digests)))
+            files = [file for file, _ in results]
+            logger.info(f"Upload cache stats: {upload_cache.stats()}, "
+                        f"{sum(shared for _, shared in results)} of {len(results)} uploads shared")
+
+            reports = [{'digest': digest, 'display_name': name} for digest, name in zip(digests, names)]
+            cl.user_session.set("reports", reports)
+            if report_index.retrieval_enabled():
+                with span("report_index", session_id, files=len(paths)):
+                    indexes = await asyncio.gather(*(
+                        asyncio.to_thread(report_index.load_or_build, path, digest)
+                        for path, digest in zip(paths, digests)))
+            searchable = [(report, index) for report, index in zip(reports, indexes) if index.has_text]
+            detached = {file.uri: report['display_name']
+                        for file, report, index in zip(files, reports, indexes) if index.has_text}
+            sharded = mapreduce.should_shard(indexes)
+            # One-time structured extraction so later list/sort/table
+            # questions can be answered locally.
+            for digest, file, name in zip(digests, files, names):
+                run_in_background(extract_report_findings(session_id, digest, file, name))
+
+            logger.info(f"Sending message to Gemini with {len(files)} uploaded file(s)")
+            file_refs = [{'digest': digest, 'name': file.name, 'display_name': name}
+                         for digest, file, name in zip(digests, files, names)]
+            content = files + [
                 message.content  # "Summarize the priority issues in this audit report and grade them by severity and order by which should be fixed first.",
-            ])
+            ]
+
+            # A first question about a report depends on nothing else, so its
+            # answer can be reused across sessions.
+            if not chat_session.history:
+                cache_key = answer_key('+'.join(digests), message.content, MODEL_FINGERPRINT)
+                cached_text = await asyncio.to_thread(answer_cache.get, cache_key)
         else:
             if not chat_session:
                 await cl.Message(content="Please upload a PDF file to analyze first.").send()
                 return
 
             logger.info("Sending message to Gemini")
-            response = chat_session.send_message(message.content)
-
-        logger.info(f"Received response from Gemini: {response.text}")
-        await cl.Message(content=response.text).send()
+            file_refs = None
+            content = message.content
+            reports = cl.user_session.get("reports") or []
+            query = findings.parse_query(message.content) if reports else None
+            if query is not None:
+                stored = await asyncio.gather(*(
+                    asyncio.to_thread(findings.load_findings, report['digest']) for report in reports))
+                # Only answer locally once every report has been extracted.
+                records = [finding for report_findings in stored for finding in report_findings or []]
+                if records and all(report_findings is not None for report_findings in stored):
+                    local_answer = findings.answer(records, query)
+            # Comparisons run over the small per-report digests, not the PDFs.
+            compared = []
+            if local_answer is None and report_digest.is_comparison(message.content):
+                compared = await asyncio.to_thread(report_digest.comparison_digests,
+                                                   message.content, reports)
+            if len(compared) >= 2:
+                logger.info(f"Comparing the digests of {', '.join(report.display_name for report in compared)}")
+                content = f"{report_digest.render(compared)}\n\nQuestion: {message.content}"
+                excerpts_sent = True
+            elif local_answer is None and reports and report_index.retrieval_enabled():
+                indexes = await asyncio.gather(*(
+                    asyncio.to_thread(report_index.load, report['digest']) for report in reports))
+            searchable = [(report, index) for report, index in zip(reports, indexes)
+                          if index is not None and index.has_text]
+            passages = []
+            attached = []
+            for report, index in searchable:
+                hits = index.search(message.content)
+                if not hits:
+                    # Nothing matched the question's words ("which should be
+                    # fixed first?"), so send the report whole if it is still
+                    # uploaded, else its opening pages.
+                    file = await scheduler.run_with_retry(session_id, upload_cache.lookup, report['digest'])
+                    if file is not None:
+                        logger.info(f"No pages of {report['display_name']} matched, sending the whole file")
+                        attached.append(file)
+                        detached[file.uri] = report['display_name']
+                        continue
+                    hits = index.leading_pages()
+                logger.info(f"Sending pages {sorted(page for page, _, _ in hits)} of {report['display_name']}")
+                if hits:
+                    passages.append(report_index.format_passages(hits, report['display_name']))
+            if passages or attached:
+                content = '\n\n'.join(passages + [f"Question: {message.content}"])
+                if attached:
+                    content = attached + [content]
+                excerpts_sent = True
+
+        if local_answer is not None:
+            logger.info("Answering from the findings store")
+            response_text, export = local_answer
+            elements = []
+            if export:
+                elements.append(cl.File(name=export[0], content=export[1].encode('utf-8'),
+                                        display="inline"))
+            chat_session.history = list(chat_session.history) + [
+                {'role': 'user', 'parts': [message.content]},
+                {'role': 'model', 'parts': [response_text]},
+            ]
+            source = "findings"
+            with span("ui_send", session_id):
+                await cl.Message(content=response_text, elements=elements).send()
+        elif cached_text is not None:
+            logger.info("Answering from the answer cache")
+            chat_session.history = list(chat_session.history) + [
+                {'role': 'user', 'parts': content},
+                {'role': 'model', 'parts': [cached_text]},
+            ]
+            response_text = cached_text
+            source = "answer_cache"
+            with span("ui_send", session_id):
+                await cl.Message(content=response_text).send()
+        else:
+            route = router.classify(message.content, new_report=bool(file_refs))
+            if sharded:
+                route = router.Route(router.PRO, "map_reduce", route.words)
+            reply = cl.Message(content="")
+            source = "model"
+
+            async def generate(target, stream_to):
+                nonlocal complete
+                with span("model_call", session_id, tier=route.tier, reason=route.reason):
+                    if sharded:
+                        text, complete = await analyze_shards(
+                            session_id, target, searchable, message.content, route, stream_to)
+                        return text
+                    return await router.send(target, content, route, stream_to, session_id)
+
+            if cache_key is None:
+                response_text = await generate(chat_session, reply)
+            else:
+                # Another session may be asking the same opening question
+                # about the same report right now; wait for its answer. The
+                # answer is generated on a chat of its own and every session
+                # that waited for it takes the exchange, so if this session
+                # stops while others wait, nothing is left in its history
+                # or streamed into its reply.
+                stop_event = cl.user_session.get("stop_event")
+                shared_chat = client.start_chat(chat_session.model, list(chat_session.history))
+
+                async def generate_shared():
+                    text = await generate(shared_chat, StopAwareReply(reply, stop_event))
+                    return text, list(shared_chat.history)
+
+                (response_text, history), shared = await questions.do(
+                    cache_key, generate_shared, stop_event=stop_event)
+                chat_session.history = history
+                if shared:
+                    source = "coalesced"
+                    reply.content = response_text
+            with span("ui_send", session_id):
+                await reply.send()
+        log_response(logger, response_text, source)
+        logger.info(f"Scheduler stats: {scheduler.stats()}")
+
+        # Keep the PDF, excerpts and digests out of the history that is resent on
+        # every later turn; follow-ups get fresh excerpts instead.
+        if searchable or excerpts_sent:
+            detach_reports(chat_session, detached, message.content if excerpts_sent else None)
+
+        # Answers missing failed shards are not cached, so asking again
+        # retries them. The cache is keyed on the Pro model, which batch.py
+        # shares, so answers from the fast tier are not stored either.
+        if cache_key is not None and cached_text is None and source != "coalesced" and complete \
+                and route.tier == router.PRO:
+            await asyncio.to_thread(answer_cache.put, cache_key, '+'.join(digests),
+                                    message.content, response_text)
+        if cache_key is not None:
+            logger.info(f"Answer cache stats: {answer_cache.stats()}")
 
         # Save the conversation history
-        await append_to_history(session_id, message.content, response.text)
-
+        with span("history_save", session_id):
+            await append_to_history(session_id, message.content, response_text, file_refs)
+        chat_sessions.touch(session_id)
+        logger.info(f"Session store stats: {chat_sessions.stats()}")
+        await asyncio.to_thread(context_window.record_turn, session_id, list(chat_session.history))
+        run_in_background(compact_context(session_id, chat_session))
+
+    except (FileWaitStopped, WaitStopped) as e:
+        logger.info(f"Session {session_id}: {str(e)}")
+        await cl.Message(content="Stopped waiting, nothing was sent to the model.").send()
+    except ServiceOverloaded as e:
+        logger.error(f"Turned away message for session {session_id}: {str(e)}")
+        await cl.Message(content=str(e)).send()
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
-        await cl.Message(content=f"An error occurred: {str(e)}").send()
+        if is_transient(e):
+            content = (f"The analysis service is busy right now ({scheduler.active + scheduler.queue_depth} "
+                       f"requests in progress or queued). Please try again in a moment.")
+        else:
+            content = f"An error occurred: {str(e)}"
+        await cl.Message(content=content).send()
 
     # Force an update to the UI
     await asyncio.sleep(0.1)
 
 
 @cl.on_chat_end
-def on_chat_end():
+async def on_chat_end():
     session_id = cl.user_session.get("session_id")
     if session_id in chat_sessions:
-        # Save the final state of the conversation
-        history = load_conversation_history(
-            session_id)  # Load existing history
-        save_conversation_history(session_id, history)
-        del chat_sessions[session_id]
+        chat_sessions.pop(session_id)
+    if session_id is not None:
+        # Every turn is already durable, just tidy the log up
+        await asyncio.to_thread(history_log.close, session_id)
     logger.info(f"Chat ended for session {session_id}")
 
 
+def thread_session_id(thread):
+    """The session id of a resumed Chainlit thread. `start` keeps it in the
+    user session, which Chainlit saves as the thread's metadata."""
+    metadata = thread.get("metadata") or {}
+    if isinstance(metadata, str):
+        metadata = json.loads(metadata)
+    return metadata.get("session_id") or thread["id"]
+
+
 @cl.on_chat_resume
 async def on_chat_resume(thread: ThreadDict):
-    session_id = thread.get("session_id")
-    if session_id not in chat_sessions:
-        chat_session = await initialize_chat(session_id)
-        chat_sessions[session_id] = chat_session
+    session_id = thread_session_id(thread)
     cl.user_session.set("session_id", session_id)
-    cl.user_session.set("chat_session", chat_sessions[session_id])
-    logger.info(f"Chat resumed for session {session_id}")
-
-    # Load and display previous messages
-    history = load_conversation_history(session_id)
-    for message in history:
-        if 'user' in message:
-            await cl.Message(content=message['user'], author="Human").send()
-        if 'model' in message:
-            await cl.Message(content=message['model']).send()
+    started = time.perf_counter()
+    # Rebuilding the model chat and showing the latest turns don't depend
+    # on each other.
+    with span("resume", session_id):
+        _, _, details = await asyncio.gather(
+            chat_sessions.get_or_load(session_id, initialize_chat),
+            replay_history(session_id),
+            asyncio.to_thread(catalog.get, session_id))
+    resumed_in = time.perf_counter() - started
+    if details and details['report_hash']:
+        cl.user_session.set("reports", [{'digest': details['report_hash'],
+                                         'display_name': details['report_name']}])
+    if details:
+        logger.info(f"Chat resumed for session {session_id} in {resumed_in:.2f}s: '{details['title']}' "
+                    f"({details['turn_count']} turns, report {details['report_name']})")
+    else:
+        logger.info(f"Chat resumed for session {session_id} in {resumed_in:.2f}s")
 
 
 @cl.on_stop
 def on_stop():
     session_id = cl.user_session.get("session_id")
+    stop_event = cl.user_session.get("stop_event")
+    if stop_event:
+        stop_event.set()
     logger.info(f"Chat stopped for session {session_id}")
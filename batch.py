@@ -0,0 +1,216 @@
+"""Batch analysis of many audit reports with a fixed question set.
+
+$ python batch.py "reports/*.pdf" --prompts questions.txt --output results.jsonl
+
+Reports are uploaded and processed concurrently, every prompt is asked of
+every report in parallel, and each answer is appended to the output (JSONL
+or CSV, by extension) as soon as it is ready. A checkpoint file records
+finished (report, prompt) pairs so an interrupted run can simply be started
+again.
+"""
+
+import os
+import csv
+import sys
+import glob
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+import statistics
+
+from model_client import client
+import models
+from upload_cache import upload_cache, file_sha256
+from file_readiness import wait_for_files_active
+from scheduler import scheduler
+from answer_cache import answer_cache, answer_key, model_fingerprint
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ['report', 'digest', 'prompt', 'answer', 'latency_s', 'cached', 'error']
+
+
+def find_reports(target):
+    if os.path.isdir(target):
+        paths = glob.glob(os.path.join(target, '**', '*.pdf'), recursive=True)
+    else:
+        paths = glob.glob(target, recursive=True)
+    return sorted(path for path in paths if os.path.isfile(path))
+
+
+def read_prompts(path):
+    """One prompt per line; blank lines and lines starting with # are ignored."""
+    with open(path, 'r') as file:
+        return [line.strip() for line in file if line.strip() and not line.startswith('#')]
+
+
+def prompt_id(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+
+
+class ResultWriter:
+    """Appends results to JSONL or CSV and records them in the checkpoint."""
+
+    def __init__(self, output, checkpoint):
+        self.output = output
+        self.checkpoint = checkpoint
+        self.done = set()
+        if os.path.exists(checkpoint):
+            with open(checkpoint, 'r') as file:
+                self.done = {line.strip() for line in file if line.strip()}
+        self._csv = output.endswith('.csv')
+        new_file = not os.path.exists(output) or os.path.getsize(output) == 0
+        self._out = open(output, 'a', newline='')
+        self._checkpoint = open(checkpoint, 'a')
+        if self._csv:
+            self._writer = csv.DictWriter(self._out, fieldnames=FIELDS)
+            if new_file:
+                self._writer.writeheader()
+
+    def write(self, result):
+        if self._csv:
+            self._writer.writerow(result)
+        else:
+            self._out.write(json.dumps(result) + '\n')
+        self._out.flush()
+        os.fsync(self._out.fileno())
+        if not result['error']:
+            key = f"{result['digest']}:{prompt_id(result['prompt'])}"
+            self.done.add(key)
+            self._checkpoint.write(key + '\n')
+            self._checkpoint.flush()
+
+    def close(self):
+        self._out.close()
+        self._checkpoint.close()
+
+
+class BatchRun:
+    def __init__(self, model, prompts, writer, workers, prompt_workers):
+        self.model = model
+        self.fingerprint = model_fingerprint(
+            model.model_name, models.GENERATION_CONFIG, models.SYSTEM_INSTRUCTION,
+            models.spec().get('tools'))
+        self.prompts = prompts
+        self.writer = writer
+        self.reports = asyncio.Semaphore(workers)
+        self.prompt_slots = asyncio.Semaphore(prompt_workers)
+        self.latencies = []
+        self.upload_latencies = []
+        self.answered = 0
+        self.skipped = 0
+        self.errors = 0
+
+    async def prepare(self, path, digest):
+        started = time.monotonic()
+        file = await scheduler.run_with_retry(path, upload_cache.lookup, digest)
+        if file is None:
+            file = await scheduler.run_with_retry(path, client.upload_file, path, "application/pdf")
+            await wait_for_files_active([file], session_id=path)
+            upload_cache.store(digest, file)
+        self.upload_latencies.append(time.monotonic() - started)
+        return file
+
+    async def ask(self, path, digest, file, prompt):
+        async with self.prompt_slots:
+            started = time.monotonic()
+            result = {'report': path, 'digest': digest, 'prompt': prompt,
+                      'answer': None, 'latency_s': None, 'cached': False, 'error': None}
+            key = answer_key(digest, prompt, self.fingerprint)
+            try:
+                text = await asyncio.to_thread(answer_cache.get, key)
+                if text is None:
+                    # A one-shot prompt has no chat state, so it is safe to retry.
+                    response = await scheduler.run_with_retry(path, self.model.generate_content, [file, prompt])
+                    text = response.text
+                    await asyncio.to_thread(answer_cache.put, key, digest, prompt, text)
+                else:
+                    result['cached'] = True
+                result['answer'] = text
+                self.answered += 1
+            except Exception as e:
+                result['error'] = str(e)
+                self.errors += 1
+                logger.error(f"{path}: prompt failed: {str(e)}")
+            result['latency_s'] = round(time.monotonic() - started, 3)
+            self.latencies.append(result['latency_s'])
+            self.writer.write(result)
+
+    async def run_report(self, path):
+        async with self.reports:
+            digest = await asyncio.to_thread(file_sha256, path)
+            pending = [prompt for prompt in self.prompts
+                       if f"{digest}:{prompt_id(prompt)}" not in self.writer.done]
+            self.skipped += len(self.prompts) - len(pending)
+            if not pending:
+                return
+            try:
+                file = await self.prepare(path, digest)
+            except Exception as e:
+                logger.error(f"{path}: upload failed: {str(e)}")
+                for prompt in pending:
+                    self.errors += 1
+                    self.writer.write({'report': path, 'digest': digest, 'prompt': prompt,
+                                       'answer': None, 'latency_s': None, 'cached': False,
+                                       'error': f"upload failed: {str(e)}"})
+                return
+            await asyncio.gather(*(self.ask(path, digest, file, prompt) for prompt in pending))
+            logger.info(f"Finished {path}")
+
+
+def summarize(run, reports, elapsed):
+    print()
+    print(f"Reports:         {len(reports)}")
+    print(f"Answers:         {run.answered} ({run.skipped} already done, {run.errors} failed)")
+    print(f"Wall time:       {elapsed:.1f}s")
+    if elapsed > 0:
+        print(f"Throughput:      {run.answered / elapsed * 60:.1f} answers/min")
+    if run.upload_latencies:
+        print(f"Upload+process:  mean {statistics.mean(run.upload_latencies):.1f}s")
+    if run.latencies:
+        latencies = sorted(run.latencies)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"Answer latency:  p50 {statistics.median(latencies):.1f}s, p95 {p95:.1f}s, "
+              f"max {latencies[-1]:.1f}s")
+
+
+async def run_batch(args):
+    reports = find_reports(args.reports)
+    prompts = read_prompts(args.prompts)
+    if not reports or not prompts:
+        print("Nothing to do: no reports matched or the prompt file is empty.")
+        return 1
+    model = models.get_model()
+    writer = ResultWriter(args.output, args.checkpoint or f"{args.output}.checkpoint")
+    run = BatchRun(model, prompts, writer, args.workers, args.prompt_workers)
+    started = time.monotonic()
+    try:
+        await asyncio.gather(*(run.run_report(path) for path in reports))
+    finally:
+        writer.close()
+        summarize(run, reports, time.monotonic() - started)
+    return 0 if run.errors == 0 else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a question set over many audit reports.")
+    parser.add_argument("reports", help="directory of PDFs or a glob such as 'reports/*.pdf'")
+    parser.add_argument("--prompts", required=True, help="file with one prompt per line")
+    parser.add_argument("--output", default="batch_results.jsonl",
+                        help="results file, .jsonl or .csv (default: batch_results.jsonl)")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="reports uploaded and processed at once (default: 4)")
+    parser.add_argument("--prompt-workers", type=int, default=8,
+                        help="prompts in flight across all reports (default: 8)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    return asyncio.run(run_batch(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
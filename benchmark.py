@@ -0,0 +1,264 @@
+"""Offline load test for app_v2.py against the fake model backend.
+
+$ python benchmark.py --sessions 20 --report report.pdf --output bench_results.json
+
+Drives N simulated Chainlit sessions concurrently through the real
+handlers (upload + question, follow-ups, then resume after the session was
+evicted) and reports p50/p95/p99 latency per stage, throughput and memory
+(max RSS, plus the traced heap peak with --trace-memory).
+A second pass measures history-log I/O cost by conversation length. All
+state is written to a scratch directory, and results are saved as JSON so
+runs can be compared with --baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import tracemalloc
+
+QUESTION = "Summarize the priority issues in this audit report and grade them by severity."
+FOLLOW_UPS = [
+    "Which of these should be fixed first and why?",
+    "What are the main risks if nothing is done?",
+    "Make that a CSV.",
+]
+HISTORY_LENGTHS = [10, 100, 1000]
+ANSWER_BYTES = 2000
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(fraction):
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'mean': round(statistics.mean(ordered), 4),
+        'p50': round(pick(0.50), 4),
+        'p95': round(pick(0.95), 4),
+        'p99': round(pick(0.99), 4),
+        'max': round(ordered[-1], 4),
+    }
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+async def simulate_session(app, cl, number, report_path, follow_ups, timings):
+    from chainlit.context import init_http_context
+
+    init_http_context()
+    await app.start()
+    session_id = cl.user_session.get("session_id")
+
+    started = time.perf_counter()
+    element = cl.File(name=os.path.basename(report_path), path=report_path, mime="application/pdf")
+    await app.main(cl.Message(content=QUESTION, elements=[element]))
+    timings['upload_and_ask'].append(time.perf_counter() - started)
+
+    for question in follow_ups:
+        started = time.perf_counter()
+        await app.main(cl.Message(content=question))
+        timings['follow_up'].append(time.perf_counter() - started)
+
+    # Drop the live session as if it had been evicted, then come back.
+    app.chat_sessions.pop(session_id)
+    init_http_context()
+    started = time.perf_counter()
+    # Chainlit hands back the thread with the saved user session as metadata.
+    await app.on_chat_resume({'id': f'thread-{session_id}', 'metadata': {'session_id': session_id}})
+    timings['resume'].append(time.perf_counter() - started)
+    await app.main(cl.Message(content=follow_ups[0] if follow_ups else QUESTION))
+    timings['resume_and_ask'].append(time.perf_counter() - started)
+
+
+async def run_sessions(args, report_copies):
+    import chainlit as cl
+    import app_v2 as app
+
+    errors = ErrorCounter()
+    logging.getLogger('app_v2').addHandler(errors)
+    timings = {'upload_and_ask': [], 'follow_up': [], 'resume': [], 'resume_and_ask': []}
+    follow_ups = FOLLOW_UPS[:args.follow_ups]
+
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        simulate_session(app, cl, number, report_copies[number], follow_ups, timings)
+        for number in range(args.sessions)))
+    elapsed = time.perf_counter() - started
+    peak = None
+    if args.trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    # `resume` is part of `resume_and_ask`, not a message of its own.
+    messages = sum(len(samples) for stage, samples in timings.items() if stage != 'resume')
+    from model_client import client
+    return {
+        'stages': {stage: percentiles(samples) for stage, samples in timings.items()},
+        'wall_time_s': round(elapsed, 3),
+        'messages': messages,
+        'throughput_msgs_per_s': round(messages / elapsed, 3) if elapsed else None,
+        'errors': errors.count,
+        'backend_calls': dict(getattr(client, 'calls', {})),
+        'memory': {
+            'tracemalloc_peak_mb': round(peak / 2 ** 20, 2) if peak is not None else None,
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+        },
+    }
+
+
+def measure_history_io(lengths, appends=20):
+    """Cost of a turn append and of full/tail reads at several history lengths."""
+    import history_log
+
+    answer = 'x' * ANSWER_BYTES
+    results = []
+    for length in lengths:
+        session_id = f'bench-{length}'
+        history_log.write_entries(session_id, [
+            {'role': 'user' if index % 2 == 0 else 'model', 'parts': ['q' if index % 2 == 0 else answer]}
+            for index in range(length * 2)])
+        samples = []
+        for _ in range(appends):
+            started = time.perf_counter()
+            history_log.append_entries(session_id, [{'role': 'user', 'parts': ['q']},
+                                                    {'role': 'model', 'parts': [answer]}])
+            samples.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        history_log.read_entries(session_id)
+        full_read = time.perf_counter() - started
+        started = time.perf_counter()
+        history_log.read_entries(session_id, tail=20)
+        tail_read = time.perf_counter() - started
+        results.append({
+            'turns': length,
+            'append_s': percentiles(samples),
+            'full_read_s': round(full_read, 5),
+            'tail_read_s': round(tail_read, 5),
+            'log_bytes': os.path.getsize(history_log.log_path(session_id)),
+        })
+    return results
+
+
+def compare(results, baseline, baseline_path):
+    print(f"\nCompared with {baseline_path}:")
+    for stage, current in results['sessions']['stages'].items():
+        previous = baseline.get('sessions', {}).get('stages', {}).get(stage)
+        if not previous or not current:
+            continue
+        change = (current['p95'] - previous['p95']) / previous['p95'] * 100 if previous['p95'] else 0
+        print(f"  {stage:16} p95 {previous['p95']:.3f}s -> {current['p95']:.3f}s ({change:+.1f}%)")
+    previous = baseline.get('sessions', {}).get('throughput_msgs_per_s')
+    if previous:
+        print(f"  throughput       {previous} -> {results['sessions']['throughput_msgs_per_s']} msgs/s")
+
+
+def print_summary(results):
+    sessions = results['sessions']
+    print(f"\n{results['config']['sessions']} sessions, {sessions['messages']} messages "
+          f"in {sessions['wall_time_s']}s ({sessions['throughput_msgs_per_s']} msgs/s), "
+          f"{sessions['errors']} errors")
+    for stage, stats in sessions['stages'].items():
+        if stats:
+            print(f"  {stage:16} p50 {stats['p50']:.3f}s  p95 {stats['p95']:.3f}s  p99 {stats['p99']:.3f}s")
+    memory = sessions['memory']
+    traced = f"peak {memory['tracemalloc_peak_mb']} MB traced, " if memory['tracemalloc_peak_mb'] else ""
+    print(f"  memory           {traced}max RSS {memory['max_rss_mb']} MB")
+    for row in results['history_io']:
+        print(f"  history {row['turns']:>5} turns: append p50 {row['append_s']['p50'] * 1000:.2f}ms, "
+              f"full read {row['full_read_s'] * 1000:.2f}ms, tail read {row['tail_read_s'] * 1000:.2f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test of app_v2.py on the fake backend.")
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent simulated sessions")
+    parser.add_argument("--follow-ups", type=int, default=2, choices=range(len(FOLLOW_UPS) + 1),
+                        help="follow-up questions per session")
+    parser.add_argument("--report", default="report.pdf", help="PDF every session uploads")
+    parser.add_argument("--shared-report", action="store_true",
+                        help="upload the same bytes in every session (exercises the caches)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="track the Python heap peak with tracemalloc (slows everything down)")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    report = os.path.abspath(args.report)
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        # Read now, the baseline may be the file this run overwrites.
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+
+    # Everything below runs against the fake backend in a scratch directory.
+    os.environ["MODEL_BACKEND"] = "fake"
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    os.environ.setdefault("METRICS_PORT", "0")
+    if not args.shared_report:
+        os.environ.setdefault("ANSWER_CACHE_BYPASS", "true")
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="cyberinsight-bench-")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    try:
+        report_copies = []
+        for number in range(args.sessions):
+            if args.shared_report:
+                report_copies.append(report)
+                continue
+            # Distinct bytes per session so every upload is a cache miss.
+            copy = os.path.join(workdir, f"report-{number}.pdf")
+            shutil.copyfile(report, copy)
+            with open(copy, 'ab') as file:
+                file.write(f"\n% benchmark copy {number}\n".encode())
+            report_copies.append(copy)
+
+        results = {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'config': {
+                'sessions': args.sessions,
+                'follow_ups': args.follow_ups,
+                'shared_report': args.shared_report,
+                'python': platform.python_version(),
+                'fake_backend': {key: value for key, value in os.environ.items()
+                                 if key.startswith("FAKE_")},
+            },
+            'sessions': asyncio.run(run_sessions(args, report_copies)),
+            'history_io': measure_history_io(HISTORY_LENGTHS),
+        }
+    finally:
+        os.chdir(os.path.dirname(output))
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print_summary(results)
+    if baseline:
+        compare(results, baseline, args.baseline)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
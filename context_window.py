@@ -0,0 +1,197 @@
+"""Keeps the history resent to the model within a token budget.
+
+The chat object resends its whole history on every turn, so long sessions
+get slower and more expensive with every question. Once the history grows
+past CONTEXT_TOKEN_BUDGET, all but the last CONTEXT_KEEP_TURNS turns are
+folded into a rolling summary written by the model. The summary is stored
+next to the history log (`summary_<id>.json`), together with how many log
+entries it covers, so a rehydrated session only has to read the turns after
+it. Report parts (the PDF or its reference) are pinned at the start of the
+history and are never folded.
+
+The full log is left untouched; only what is sent to the model changes.
+"""
+
+import os
+import json
+import time
+import logging
+
+import history_log
+from model_client import client
+from metrics import registry, record_usage
+
+logger = logging.getLogger(__name__)
+
+TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "32000"))
+KEEP_TURNS = int(os.environ.get("CONTEXT_KEEP_TURNS", "4"))
+SUMMARY_MAX_TOKENS = 2048
+# Rough but cheap; the budget is a soft limit.
+CHARS_PER_TOKEN = 4
+
+SUMMARY_HEADER = "Summary of the earlier conversation about this report:"
+SUMMARY_ACK = "Understood. I will use this summary as context for the following questions."
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and a cybersecurity analyst about an audit report.
+Update the summary below with the new turns. Keep every concrete fact the user may refer back to:
+findings discussed and their priorities or severities, decisions, numbers, owners, deadlines, and the
+formats the user asked for. Drop pleasantries and repetition. Answer with the updated summary only."""
+
+CONTEXT_TOKENS = registry.counter(
+    "cyberinsight_context_tokens",
+    "Estimated history tokens per turn: sent to the model, or saved by summarizing.",
+    ["kind"])
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def summary_path(session_id):
+    return os.path.join(history_log.HISTORY_DIR, f'summary_{session_id}.json')
+
+
+def load_summary(session_id):
+    path = summary_path(session_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except ValueError:
+        logger.warning(f"Ignoring unreadable context summary {path}")
+        return None
+
+
+def save_summary(session_id, record):
+    os.makedirs(history_log.HISTORY_DIR, exist_ok=True)
+    tmp_path = summary_path(session_id) + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(record, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, summary_path(session_id))
+
+
+def _is_file_part(part):
+    return not isinstance(part, str) and 'file_data' in part
+
+
+def content_tokens(contents):
+    """Estimated text tokens of a list of Content protos. File parts are
+    pinned outside the budget and not counted."""
+    tokens = 0
+    for content in contents:
+        for part in content.parts:
+            if part.text:
+                tokens += estimate_tokens(part.text)
+    return tokens
+
+
+def summary_preamble(pinned_parts, summary):
+    """The user/model exchange that opens a compacted history."""
+    return [
+        {'role': 'user', 'parts': list(pinned_parts) + [f"{SUMMARY_HEADER}\n{summary}"]},
+        {'role': 'model', 'parts': [SUMMARY_ACK]},
+    ]
+
+
+def _has_preamble(contents):
+    return (len(contents) >= 2 and contents[0].parts
+            and contents[0].parts[-1].text.startswith(SUMMARY_HEADER))
+
+
+def _transcript(contents, is_pinned):
+    lines = []
+    for content in contents:
+        speaker = "User" if content.role == 'user' else "Analyst"
+        for part in content.parts:
+            if part.text and not is_pinned(part):
+                lines.append(f"{speaker}: {part.text}")
+    return "\n\n".join(lines)
+
+
+def summarize(previous, transcript, model_name):
+    """Folds `transcript` into `previous` with one model call. Blocking."""
+    model = client.generative_model(
+        model_name=model_name,
+        generation_config={"temperature": 0.1, "max_output_tokens": SUMMARY_MAX_TOKENS},
+    )
+    response = model.generate_content([
+        SUMMARY_PROMPT,
+        f"Current summary:\n{previous or '(none yet)'}",
+        f"New turns:\n{transcript}",
+    ])
+    record_usage(getattr(response, 'usage_metadata', None), model_name)
+    return response.text.strip()
+
+
+def plan_compaction(contents, budget=TOKEN_BUDGET, keep_turns=KEEP_TURNS):
+    """Returns how many contents after the preamble to fold, or 0."""
+    if content_tokens(contents) <= budget:
+        return 0
+    start = 2 if _has_preamble(contents) else 0
+    foldable = len(contents) - start - keep_turns * 2
+    # Fold whole user/model turns only.
+    return max(foldable - foldable % 2, 0)
+
+
+def compact(session_id, contents, model_name, is_pinned=_is_file_part,
+            budget=TOKEN_BUDGET, keep_turns=KEEP_TURNS):
+    """Summarizes the oldest turns of `contents` (a chat history snapshot) if
+    it is over `budget`.
+
+    Blocking; run it off the event loop. Returns (history, record): the new
+    history to install on the chat session and the summary record to save
+    with `save_summary` once it is installed. Returns None if nothing needed
+    folding. Nothing is written here, so a result the caller drops because
+    the chat moved on in the meantime leaves no trace.
+    """
+    fold = plan_compaction(contents, budget, keep_turns)
+    if not fold:
+        return None
+    empty = {'summary': '', 'covered': 0, 'covered_tokens': 0, 'files': []}
+    start = 2 if _has_preamble(contents) else 0
+    if start:
+        record = load_summary(session_id) or empty
+        pinned = list(contents[0].parts)[:-1]
+    else:
+        # Without a preamble this history starts at the first log entry, so
+        # any summary on disk is stale.
+        record = empty
+        pinned = []
+    folded = contents[start:start + fold]
+    recent = contents[start + fold:]
+    pinned += [part for content in folded for part in content.parts if is_pinned(part)]
+
+    started = time.monotonic()
+    summary = summarize(record['summary'], _transcript(folded, is_pinned), model_name)
+    # Log entries map one to one onto the contents after the preamble.
+    covered = record['covered'] + fold
+    files = list(record['files'])
+    for entry in history_log.read_entries(session_id, start=record['covered'], stop=covered):
+        files.extend(ref for ref in entry.get('files', []) if ref not in files)
+    new_record = {
+        'summary': summary,
+        'covered': covered,
+        'covered_tokens': record['covered_tokens'] + content_tokens(folded),
+        'summary_tokens': estimate_tokens(summary),
+        'files': files,
+        'updated_at': time.time(),
+    }
+    logger.info(f"Summarized {fold // 2} turns of session {session_id} "
+                f"in {time.monotonic() - started:.1f}s ({covered} log entries covered)")
+    return summary_preamble(pinned, summary) + recent, new_record
+
+
+def record_turn(session_id, contents):
+    """Logs and counts the history tokens sent this turn, and those saved."""
+    sent = content_tokens(contents)
+    record = load_summary(session_id)
+    saved = 0
+    if record:
+        saved = max(record['covered_tokens'] - record.get('summary_tokens', 0), 0)
+    CONTEXT_TOKENS.inc(sent, kind='sent')
+    CONTEXT_TOKENS.inc(saved, kind='saved')
+    logger.info(f"Context for session {session_id}: ~{sent} history tokens sent, "
+                f"~{saved} saved by summarizing")
+    return sent, saved
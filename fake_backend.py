@@ -0,0 +1,235 @@
+"""Local stand-in for the Gemini API, for benchmarks and load tests.
+
+Select it with MODEL_BACKEND=fake. Uploaded files stay PROCESSING for a
+configurable time, answers are generated at a configurable token rate and
+size, and a configurable fraction of calls fail with the same exceptions
+the real API raises. Chat history uses the SDK's own content types, so the
+rest of the app cannot tell the difference.
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import threading
+from types import SimpleNamespace
+from datetime import datetime, timezone, timedelta
+
+from google.api_core import exceptions
+from google.generativeai import protos
+from google.generativeai.types import content_types, file_types
+
+from model_client import ModelClient
+
+_WORDS = ("the council should review privileged access controls and patch "
+          "management processes to reduce exposure across the network").split()
+TOKENS_PER_CHUNK = 20
+FILE_PART_TOKENS = 1000
+
+
+class FakeChunk:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeResponse:
+    """A generated answer, replayed at the backend's token rate.
+
+    Iterating yields chunks the way a `stream=True` response does. A stream
+    picked to fail raises `error` in place of chunk number `fail_at`.
+    """
+
+    def __init__(self, backend, text, usage_metadata, stream, error=None, fail_at=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+        self._backend = backend
+        self._stream = stream
+        self._error = error
+        self._fail_at = fail_at
+        self.on_complete = None
+
+    def __iter__(self):
+        if not self._stream:
+            yield self
+            return
+        words = self.text.split(' ')
+        for start in range(0, len(words), TOKENS_PER_CHUNK):
+            chunk = words[start:start + TOKENS_PER_CHUNK]
+            delay = len(chunk) / self._backend.token_rate
+            if start == 0:
+                delay += self._backend.first_token_delay
+            time.sleep(delay)
+            if self._error is not None and start // TOKENS_PER_CHUNK == self._fail_at:
+                raise self._error
+            last = start + TOKENS_PER_CHUNK >= len(words)
+            yield FakeChunk(' '.join(chunk) + ('' if last else ' '),
+                            self.usage_metadata if last else None)
+        if self.on_complete is not None:
+            self.on_complete(self.text)
+
+
+class FakeChatSession:
+    def __init__(self, model, history=None):
+        self.model = model
+        self._history = content_types.to_contents(history) if history else []
+        self.last = None
+
+    @property
+    def history(self):
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        self._history = content_types.to_contents(history) if history else []
+        self.last = None
+
+    def send_message(self, content, stream=False):
+        sent = content_types.to_content(content)
+        sent.role = 'user'
+        response = self.model._respond(self._history + [sent], stream)
+
+        def complete(text):
+            self._history.extend([sent, protos.Content(role='model', parts=[protos.Part(text=text)])])
+            self.last = None
+
+        if stream:
+            self.last = response
+            response.on_complete = complete
+        else:
+            complete(response.text)
+        return response
+
+    def rewind(self):
+        if self.last is not None:
+            self.last = None
+            return None
+        return self._history.pop(-2), self._history.pop()
+
+
+class FakeModel:
+    def __init__(self, backend, model_name="fake-model", generation_config=None, **kwargs):
+        self._backend = backend
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self._generation_config = dict(generation_config or {})
+
+    def _respond(self, contents, stream):
+        backend = self._backend
+        # Whether the call fails is drawn once; a stream fails part way.
+        error = backend.draw_failure("generate")
+        if error is not None and not stream:
+            raise error
+        prompt_tokens = 0
+        for content in contents:
+            for part in content.parts:
+                prompt_tokens += len(part.text.split()) if part.text else FILE_PART_TOKENS
+        if self._generation_config.get("response_mime_type") == "application/json":
+            text = json.dumps(backend.fake_findings())
+        else:
+            text = ' '.join(backend.random.choice(_WORDS) for _ in range(backend.response_tokens))
+        output_tokens = len(text.split())
+        usage = SimpleNamespace(prompt_token_count=prompt_tokens,
+                                candidates_token_count=output_tokens,
+                                total_token_count=prompt_tokens + output_tokens)
+        if not stream:
+            time.sleep(backend.first_token_delay + output_tokens / backend.token_rate)
+        with backend._lock:
+            backend.calls["generate"] += 1
+            fail_at = backend.random.randrange(-(-output_tokens // TOKENS_PER_CHUNK)) if error else None
+        return FakeResponse(backend, text, usage, stream, error, fail_at)
+
+    def generate_content(self, contents, stream=False):
+        return self._respond(content_types.to_contents(contents), stream)
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+
+class FakeClient(ModelClient):
+    def __init__(self, processing_delay=2.0, upload_delay=0.2, first_token_delay=0.5,
+                 token_rate=50.0, error_rate=0.0, response_tokens=400, seed=None):
+        self.processing_delay = processing_delay
+        self.upload_delay = upload_delay
+        self.first_token_delay = first_token_delay
+        self.token_rate = token_rate
+        self.error_rate = error_rate
+        self.response_tokens = response_tokens
+        self.random = random.Random(seed)
+        self.calls = {"upload": 0, "get_file": 0, "generate": 0, "errors": 0}
+        self._files = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        seed = os.environ.get("FAKE_SEED")
+        return cls(
+            processing_delay=float(os.environ.get("FAKE_PROCESSING_DELAY", "2.0")),
+            upload_delay=float(os.environ.get("FAKE_UPLOAD_DELAY", "0.2")),
+            first_token_delay=float(os.environ.get("FAKE_FIRST_TOKEN_DELAY", "0.5")),
+            token_rate=float(os.environ.get("FAKE_TOKEN_RATE", "50")),
+            error_rate=float(os.environ.get("FAKE_ERROR_RATE", "0")),
+            response_tokens=int(os.environ.get("FAKE_RESPONSE_TOKENS", "400")),
+            seed=int(seed) if seed else None,
+        )
+
+    def draw_failure(self, operation):
+        """Decides whether one call fails. Returns the error to raise, or None."""
+        with self._lock:
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.calls["errors"] += 1
+            rate_limited = self.random.random() < 0.5
+        if not failed:
+            return None
+        if rate_limited:
+            return exceptions.ResourceExhausted(f"Resource has been exhausted (fake {operation})")
+        return exceptions.ServiceUnavailable(f"The service is currently unavailable (fake {operation})")
+
+    def maybe_fail(self, operation):
+        error = self.draw_failure(operation)
+        if error is not None:
+            raise error
+
+    def fake_findings(self):
+        return [
+            {"id": str(number), "title": f"Finding {number}", "priority": 1 + number % 3,
+             "severity": ("High", "Medium", "Low")[number % 3],
+             "recommendation": "Review and remediate.", "deadline": "2021-12-31",
+             "owner": "Head of IT", "page": number + 2}
+            for number in range(1, 7)
+        ]
+
+    def upload_file(self, path, mime_type=None):
+        time.sleep(self.upload_delay)
+        self.maybe_fail("upload")
+        name = f"files/fake-{uuid.uuid4().hex[:12]}"
+        proto = protos.File(
+            name=name,
+            display_name=os.path.basename(path),
+            mime_type=mime_type or "application/octet-stream",
+            size_bytes=os.path.getsize(path),
+            uri=f"https://fake.local/v1beta/{name}",
+            state=protos.File.State.PROCESSING,
+            expiration_time=datetime.now(timezone.utc) + timedelta(hours=48),
+        )
+        with self._lock:
+            self._files[name] = (proto, time.monotonic() + self.processing_delay)
+            self.calls["upload"] += 1
+        return file_types.File(proto)
+
+    def get_file(self, name):
+        self.maybe_fail("get_file")
+        with self._lock:
+            self.calls["get_file"] += 1
+            entry = self._files.get(name)
+        if entry is None:
+            raise exceptions.NotFound(f"File {name} not found (fake)")
+        proto, ready_at = entry
+        proto = type(proto)(proto)
+        if time.monotonic() >= ready_at:
+            proto.state = protos.File.State.ACTIVE
+        return file_types.File(proto)
+
+    def generative_model(self, **kwargs):
+        return FakeModel(self, **kwargs)
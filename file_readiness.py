@@ -0,0 +1,77 @@
+import os
+import time
+import random
+import asyncio
+import logging
+
+from model_client import client
+from scheduler import scheduler
+
+logger = logging.getLogger(__name__)
+
+READY_TIMEOUT = float(os.environ.get("FILE_READY_TIMEOUT", "300"))
+INITIAL_DELAY = 0.5
+MAX_DELAY = 8.0
+
+
+class FileProcessingError(Exception):
+    pass
+
+
+class FileWaitStopped(Exception):
+    """The user stopped the chat while its files were still processing."""
+
+
+async def _sleep_or_stop(delay, stop_event):
+    """Sleeps for `delay` seconds, returning early if `stop_event` is set."""
+    if stop_event is None:
+        await asyncio.sleep(delay)
+        return
+    try:
+        await asyncio.wait_for(stop_event.wait(), timeout=delay)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def _wait_for_file(name, deadline, stop_event, session_id):
+    delay = INITIAL_DELAY
+    while True:
+        if stop_event is not None and stop_event.is_set():
+            raise FileWaitStopped(f"Stopped while waiting for {name}")
+        file = await scheduler.run_with_retry(session_id, client.get_file, name)
+        if file.state.name != "PROCESSING":
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise FileProcessingError(f"File {name} was still processing after {READY_TIMEOUT:.0f}s")
+        # Full jitter keeps many sessions from polling in lock-step.
+        await _sleep_or_stop(min(random.uniform(0, delay), remaining), stop_event)
+        delay = min(delay * 2, MAX_DELAY)
+    if file.state.name != "ACTIVE":
+        raise FileProcessingError(f"File {file.name} failed to process")
+    return file
+
+
+async def wait_for_files_active(files, timeout=READY_TIMEOUT, stop_event=None,
+                                session_id=None):
+    """Waits, without blocking the event loop, for all `files` to be ACTIVE.
+
+    Files are polled concurrently through the shared scheduler with jittered
+    exponential backoff. Raises FileProcessingError if a file fails or the
+    deadline passes, and FileWaitStopped if `stop_event` is set while
+    waiting.
+    """
+    logger.info("Waiting for file processing...")
+    started = time.monotonic()
+    deadline = started + timeout
+    tasks = [
+        asyncio.create_task(_wait_for_file(file.name, deadline, stop_event, session_id))
+        for file in files
+    ]
+    try:
+        ready = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    logger.info(f"...all files ready in {time.monotonic() - started:.1f}s")
+    return ready
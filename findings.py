@@ -0,0 +1,360 @@
+"""Structured findings extracted from audit reports, and a small local query
+engine over them.
+
+Each report gets one extraction pass that turns its findings into typed
+records, stored by content hash. Questions that are really filters, sorts,
+counts or exports over those records ("list priority 1 findings", "show
+deadlines and owners as a table", "export as csv") are then answered
+locally instead of by a fresh model generation.
+"""
+
+import io
+import os
+import re
+import csv
+import json
+import logging
+import threading
+from dataclasses import dataclass, asdict, fields
+
+from model_client import client
+from metrics import record_usage
+
+logger = logging.getLogger(__name__)
+
+FINDINGS_DIR = os.environ.get("FINDINGS_DIR", os.path.join("cache", "findings"))
+
+EXTRACTION_PROMPT = """Extract every audit finding (issue) from the attached report.
+Return a JSON array. Each element must be an object with these keys:
+"id" (the finding or issue number as written in the report, as a string),
+"title" (short name of the finding),
+"priority" (integer priority/risk rating as written in the report, or null),
+"severity" (one of "Critical", "High", "Medium", "Low", or null),
+"recommendation" (the report's recommendation, one or two sentences),
+"deadline" (agreed implementation date as written, or null),
+"owner" (responsible officer or team, or null),
+"page" (integer page number where the finding is described, or null).
+Only include findings that are in the report. Do not invent values."""
+
+SEVERITY_RANK = {'critical': 0, 'high': 1, 'medium': 2, 'low': 3}
+
+COLUMNS = {
+    'id': '#',
+    'title': 'Finding',
+    'priority': 'Priority',
+    'severity': 'Severity',
+    'recommendation': 'Recommendation',
+    'deadline': 'Deadline',
+    'owner': 'Responsible Officer',
+    'page': 'Page',
+}
+DEFAULT_COLUMNS = ['id', 'title', 'priority', 'severity']
+
+# Words that ask for judgement rather than a lookup; those go to the model.
+_OPEN_ENDED = re.compile(
+    r'\b(why|explain|how (should|would|could|can|do)|compare|summari[sz]e|analy[sz]e|'
+    r'impact|risks? of|advise|suggest|improve|what should|assess|opinion)\b')
+_STRUCTURED = re.compile(
+    r'\b(list|show|which|what are|give|table|tabular|export|csv|json|count|how many|'
+    r'number of|order|sort|rank|top \d+|all)\b')
+_SUBJECT = re.compile(r'\b(findings?|issues?|recommendations?|deadlines?|officers?|owners?)\b')
+_COLUMN_WORDS = {
+    'recommendation': r'recommendation',
+    'deadline': r'deadline|due|date|timeline',
+    'owner': r'owner|officer|responsible',
+    'page': r'page',
+}
+_SORT_WORDS = {
+    'severity': r'severity|severe',
+    'priority': r'priority|priorit',
+    'deadline': r'deadline|due|date',
+    'page': r'page',
+}
+_ORDER = re.compile(r'\b(?:in\s+order\s+of|(?:order|ordered|sort|sorted|rank|ranked|grade|graded|'
+                    r'arrange|arranged)\s+(?:them\s+)?by)\s+(\w+)')
+# Every word of a question answered locally must be one the parser reads or
+# one of these; anything else (a topic such as "firewall", a free-text
+# filter) means the question is about more than the records can say.
+_FILLER = frozenset("""
+a all along also an and any are as at be by can could display do does download each every
+export file for format formatted from get give how i in include including is it its json list
+many markdown me my number of on only or order ordered our out please plus provide rank
+ranked report reports return s show sort sorted table tabular that the their them there these
+this those to top us want what which with would you your csv count grade graded arrange
+arranged first
+""".split())
+_VOCABULARY = re.compile(
+    r'findings?|issues?|recommendations?|deadlines?|officers?|owners?|responsible|due|dates?|'
+    r'timelines?|pages?|severity|severities|severe|priority|priorities|risks?')
+# Numbers, severity levels and "rated" only count as read where a filter
+# below uses them.
+_LEVELS = r'(?:critical|high|medium|low)(?:\s*(?:,|and|or|&)\s*(?:critical|high|medium|low))*'
+_NUMBERS = r'\d+(?:\.\d+)*(?:\s*(?:,|and|or|&)\s*\d+(?:\.\d+)*)*'
+_PRIORITY_FILTERS = [rf'\bpriorit(?:y|ies)\s*({_NUMBERS})', r'\bp(\d)\b']
+# "low priority" is left out on purpose: priorities are numbers in the reports.
+_SEVERITY_FILTERS = [rf'\b({_LEVELS})(?:\s+|-)(?:severity|risk|rated|findings?|issues?)\b',
+                     rf'\brated\s+(?:as\s+)?({_LEVELS})\b']
+_ID_FILTER = rf'\b(?:findings?|issues?|recommendations?)\s+(?:no\.?\s*|number\s+)?({_NUMBERS})\b'
+_PAGE_FILTER = r'\bpages?\s+(\d+)(?:\s*(?:-|to)\s*(\d+))?\b'
+_LIMITS = [r'\b(?:top|first)\s+(\d+)\b', r'\b(?:list|show|give)(?:\s+me)?(?:\s+the)?\s+(\d+)\b']
+
+
+@dataclass
+class Finding:
+    id: str
+    title: str
+    priority: int = None
+    severity: str = None
+    recommendation: str = None
+    deadline: str = None
+    owner: str = None
+    page: int = None
+
+    @classmethod
+    def from_dict(cls, data):
+        known = {field.name for field in fields(cls)}
+        record = {key: value for key, value in data.items() if key in known}
+        for key in ('priority', 'page'):
+            try:
+                record[key] = int(record[key]) if record.get(key) is not None else None
+            except (TypeError, ValueError):
+                record[key] = None
+        record['id'] = str(record.get('id') or '')
+        record['title'] = str(record.get('title') or '')
+        return cls(**record)
+
+
+@dataclass
+class FindingsQuery:
+    priorities: list
+    severities: list
+    sort_by: str
+    limit: int
+    columns: list
+    output: str
+    count: bool
+    ids: list
+    pages: list
+
+
+def findings_path(digest):
+    return os.path.join(FINDINGS_DIR, f'{digest}.json')
+
+
+def load_findings(digest):
+    path = findings_path(digest)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        return [Finding.from_dict(item) for item in json.load(file)]
+
+
+def save_findings(digest, findings):
+    os.makedirs(FINDINGS_DIR, exist_ok=True)
+    tmp_path = findings_path(digest) + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump([asdict(finding) for finding in findings], file)
+    os.replace(tmp_path, findings_path(digest))
+
+
+_extracting = set()
+_extracting_lock = threading.Lock()
+
+
+def extract_findings(digest, file, model_name):
+    """Runs the one-time extraction pass for a report, unless already stored.
+
+    Blocking; run it on the scheduler. Returns the stored findings, or None if
+    another extraction for the same report is already in progress.
+    """
+    findings = load_findings(digest)
+    if findings is not None:
+        return findings
+    with _extracting_lock:
+        if digest in _extracting:
+            return None
+        _extracting.add(digest)
+    try:
+        model = client.generative_model(
+            model_name=model_name,
+            generation_config={"temperature": 0, "response_mime_type": "application/json"},
+        )
+        response = model.generate_content([file, EXTRACTION_PROMPT])
+        record_usage(getattr(response, 'usage_metadata', None), model_name)
+        records = json.loads(response.text)
+        if isinstance(records, dict):
+            records = records.get('findings', [])
+        findings = [Finding.from_dict(record) for record in records if isinstance(record, dict)]
+        save_findings(digest, findings)
+        logger.info(f"Extracted {len(findings)} findings from report {digest[:12]}")
+        return findings
+    finally:
+        with _extracting_lock:
+            _extracting.discard(digest)
+
+
+def _sort_field(word):
+    return next((key for key, pattern in _SORT_WORDS.items() if re.match(pattern, word)), None)
+
+
+def _read(pattern, question, spans):
+    """Matches of `pattern` in `question`; the text they cover counts as read."""
+    matches = list(re.finditer(pattern, question))
+    spans.extend(match.span() for match in matches)
+    return matches
+
+
+def parse_query(text):
+    """Turns a structured question into a FindingsQuery, or None if it is
+    open-ended or says anything the parser does not read (a topic, a free-text
+    filter, a number no filter uses, an unknown sort), so that the model
+    answers it instead."""
+    question = ' '.join(text.lower().split())
+    if _OPEN_ENDED.search(question) or not _STRUCTURED.search(question) \
+            or not _SUBJECT.search(question):
+        return None
+
+    spans = []
+    priorities = [int(value) for pattern in _PRIORITY_FILTERS
+                  for match in _read(pattern, question, spans)
+                  for value in re.findall(r'\d+', match.group(1))]
+    levels = {level for pattern in _SEVERITY_FILTERS
+              for match in _read(pattern, question, spans)
+              for level in re.findall(r'[a-z]+', match.group(1)) if level in SEVERITY_RANK}
+    severities = [level for level in SEVERITY_RANK if level in levels]
+    ids = [value for match in _read(_ID_FILTER, question, spans)
+           for value in re.findall(r'\d+(?:\.\d+)*', match.group(1))]
+    pages = []
+    for match in _read(_PAGE_FILTER, question, spans):
+        first = int(match.group(1))
+        pages += range(first, int(match.group(2) or first) + 1)
+    limits = [int(match.group(1)) for pattern in _LIMITS for match in _read(pattern, question, spans)]
+
+    unread = [match.group() for match in re.finditer(r'[a-z0-9]+', question)
+              if match.group() not in _FILLER and not _VOCABULARY.fullmatch(match.group())
+              and not any(start <= match.start() and match.end() <= end for start, end in spans)]
+    if unread:
+        logger.debug(f"Not a findings query, unread words: {unread}")
+        return None
+
+    sort_by = None
+    order = _ORDER.search(question)
+    if order:
+        sort_by = _sort_field(order.group(1))
+    elif re.search(r'\bby (severity|priority)\b', question):
+        sort_by = re.search(r'\bby (severity|priority)\b', question).group(1)
+    # "by owner" or "in order of title" asks for something run_query can't do.
+    if (order and sort_by is None) or any(_sort_field(word) is None
+                                          for word in re.findall(r'\bby\s+(\w+)', question)):
+        return None
+
+    limit = limits[0] if limits else None
+    if limit and not sort_by:
+        sort_by = 'priority'
+
+    columns = list(DEFAULT_COLUMNS)
+    for column, pattern in _COLUMN_WORDS.items():
+        if re.search(pattern, question):
+            columns.append(column)
+
+    if re.search(r'\bcsv\b', question):
+        output = 'csv'
+    elif re.search(r'\bjson\b', question):
+        output = 'json'
+    else:
+        output = 'table'
+
+    count = bool(re.search(r'\b(how many|count|number of)\b', question))
+    return FindingsQuery(sorted(set(priorities)), severities, sort_by, limit, columns, output, count,
+                         ids, sorted(set(pages)))
+
+
+def _sort_key(sort_by):
+    def key(finding):
+        if sort_by == 'severity':
+            return (SEVERITY_RANK.get((finding.severity or '').lower(), 99),
+                    finding.priority if finding.priority is not None else 99)
+        if sort_by == 'priority':
+            return (finding.priority if finding.priority is not None else 99,
+                    SEVERITY_RANK.get((finding.severity or '').lower(), 99))
+        value = getattr(finding, sort_by)
+        return (value is None, str(value) if sort_by == 'deadline' else (value or 0))
+    return key
+
+
+def _id_number(finding):
+    """The number in a finding's id ("Issue 3", "#3", "3"), or its id as is."""
+    number = re.search(r'\d+(?:\.\d+)*', finding.id)
+    return number.group() if number else finding.id
+
+
+def run_query(findings, query):
+    selected = [finding for finding in findings
+                if (not query.priorities or finding.priority in query.priorities)
+                and (not query.severities or (finding.severity or '').lower() in query.severities)
+                and (not query.ids or _id_number(finding) in query.ids)
+                and (not query.pages or finding.page in query.pages)]
+    if query.sort_by:
+        selected.sort(key=_sort_key(query.sort_by))
+    if query.limit:
+        selected = selected[:query.limit]
+    return selected
+
+
+def _cell(value):
+    return '' if value is None else str(value).replace('|', '\\|').replace('\n', ' ')
+
+
+def to_markdown(findings, columns):
+    lines = ['| ' + ' | '.join(f'**{COLUMNS[column]}**' for column in columns) + ' |',
+             '|' + '---|' * len(columns)]
+    for finding in findings:
+        lines.append('| ' + ' | '.join(_cell(getattr(finding, column)) for column in columns) + ' |')
+    return '\n'.join(lines)
+
+
+def to_csv(findings, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow([COLUMNS[column] for column in columns])
+    for finding in findings:
+        writer.writerow(['' if getattr(finding, column) is None else getattr(finding, column)
+                         for column in columns])
+    return buffer.getvalue()
+
+
+def to_json(findings, columns):
+    return json.dumps([{column: getattr(finding, column) for column in columns}
+                       for finding in findings], indent=2)
+
+
+def _counts(findings, attribute):
+    counts = {}
+    for finding in findings:
+        value = getattr(finding, attribute)
+        label = 'Unrated' if value is None else str(value)
+        counts[label] = counts.get(label, 0) + 1
+    return counts
+
+
+def answer(findings, query):
+    """Renders the result of `query`. Returns (text, export) where export is
+    (filename, content) for CSV/JSON requests, else None."""
+    selected = run_query(findings, query)
+    if query.count:
+        lines = [f"There are **{len(selected)}** matching findings."]
+        for attribute in ('priority', 'severity'):
+            counts = _counts(selected, attribute)
+            if len(counts) > 1:
+                lines.append(f"\nBy {attribute}:")
+                lines.extend(f"- {label}: {count}" for label, count in sorted(counts.items()))
+        return '\n'.join(lines), None
+    if not selected:
+        return "No findings in this report match that request.", None
+    if query.output == 'csv':
+        content = to_csv(selected, query.columns)
+        return f"```csv\n{content}```", ('findings.csv', content)
+    if query.output == 'json':
+        content = to_json(selected, query.columns)
+        return f"```json\n{content}\n```", ('findings.json', content)
+    return to_markdown(selected, query.columns), None
@@ -2,7 +2,9 @@ import chainlit as cl
 import markdown
 # from rich.console import Console
 from rich.markdown import Markdown
-from ai import *
+from ai import upload_to_gemini
+from file_readiness import wait_for_files_active
+from models import get_model
 import re
 
 def sanitize_filename(filename):
@@ -35,9 +37,10 @@ async def start():
         file = files[0]
         sanitized_name = sanitize_filename(file.name.split('.')[0])
         file.name = sanitized_name + '.pdf'
-    wait_for_files_active(files)
+    files = [upload_to_gemini(file.path, mime_type=file.type) for file in files]
+    await wait_for_files_active(files)
     global chat_session
-    chat_session = model.start_chat(
+    chat_session = get_model().start_chat(
     history=[
         {
         "role": "user",
@@ -0,0 +1,252 @@
+import os
+import json
+import struct
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DIR = 'chat_histories'
+# Rewrite a session log after this many appends, dropping corrupt lines and
+# rebuilding its index.
+COMPACT_EVERY = int(os.environ.get("HISTORY_COMPACT_EVERY", "50"))
+
+_OFFSET = struct.Struct('<Q')
+_locks = defaultdict(threading.Lock)
+_appends_since_compaction = defaultdict(int)
+
+
+def log_path(session_id):
+    return os.path.join(HISTORY_DIR, f'conversation_{session_id}.jsonl')
+
+
+def index_path(session_id):
+    return os.path.join(HISTORY_DIR, f'conversation_{session_id}.idx')
+
+
+def legacy_path(session_id):
+    return os.path.join(HISTORY_DIR, f'conversation_{session_id}.json')
+
+
+def _fsync_dir(folder):
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _encode(entry):
+    return (json.dumps(entry) + '\n').encode('utf-8')
+
+
+def _read_offsets(session_id):
+    path = index_path(session_id)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as file:
+        data = file.read()
+    usable = len(data) - len(data) % _OFFSET.size
+    return [offset for (offset,) in _OFFSET.iter_unpack(data[:usable])]
+
+
+def _scan_lines(path, start=0):
+    """Returns the offsets of complete lines from byte `start` on, and where
+    the last complete line ends."""
+    offsets = []
+    position = start
+    with open(path, 'rb') as file:
+        file.seek(start)
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            offsets.append(position)
+            position += len(line)
+    return offsets, position
+
+
+def _write_all(session_id, entries):
+    """Atomically replaces a session's log and index with `entries`."""
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    offsets = []
+    position = 0
+    tmp_log = log_path(session_id) + '.tmp'
+    with open(tmp_log, 'wb') as file:
+        for entry in entries:
+            line = _encode(entry)
+            offsets.append(position)
+            position += len(line)
+            file.write(line)
+        file.flush()
+        os.fsync(file.fileno())
+    tmp_index = index_path(session_id) + '.tmp'
+    with open(tmp_index, 'wb') as file:
+        file.write(b''.join(_OFFSET.pack(offset) for offset in offsets))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_log, log_path(session_id))
+    os.replace(tmp_index, index_path(session_id))
+    _fsync_dir(HISTORY_DIR)
+
+
+def _migrate_legacy(session_id):
+    """Converts a pre-JSONL `conversation_<id>.json` file into a log."""
+    path = legacy_path(session_id)
+    if os.path.exists(log_path(session_id)) or not os.path.exists(path):
+        return
+    try:
+        with open(path, 'r') as file:
+            entries = json.load(file)
+    except ValueError:
+        # Truncated by a crash during the old load-and-rewrite save.
+        logger.warning(f"Legacy history {path} is corrupt, starting an empty log")
+        entries = []
+    _write_all(session_id, entries)
+    os.replace(path, path + '.migrated')
+    logger.info(f"Migrated {path} to {log_path(session_id)} ({len(entries)} entries)")
+
+
+def _load_index(session_id):
+    """Returns the session's offsets, repairing the log tail and the index."""
+    _migrate_legacy(session_id)
+    path = log_path(session_id)
+    if not os.path.exists(path):
+        return []
+    indexed = _read_offsets(session_id)
+    size = os.path.getsize(path)
+    offsets = list(indexed)
+    if offsets and offsets[-1] >= size:
+        # Index points past the log, rebuild it from scratch.
+        offsets = []
+    # Rescan from the last indexed line to pick up lines written before a
+    # crash stopped the index append.
+    start = offsets.pop() if offsets else 0
+    tail, end = _scan_lines(path, start)
+    offsets.extend(tail)
+    if end < size:
+        # Torn final write, drop it so the next append starts on a new line.
+        with open(path, 'rb+') as file:
+            file.truncate(end)
+    if offsets != indexed:
+        with open(index_path(session_id), 'wb') as file:
+            file.write(b''.join(_OFFSET.pack(offset) for offset in offsets))
+    return offsets
+
+
+def append_entries(session_id, entries):
+    """Appends `entries` to the session log and fsyncs before returning.
+
+    All entries go out in a single write, so a crash leaves at most one torn
+    line at the end, which is dropped the next time the log is opened.
+    """
+    with _locks[session_id]:
+        offsets = _load_index(session_id)
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+        path = log_path(session_id)
+        with open(path, 'ab') as file:
+            position = file.tell()
+            lines = [_encode(entry) for entry in entries]
+            new_offsets = []
+            for line in lines:
+                new_offsets.append(position)
+                position += len(line)
+            file.write(b''.join(lines))
+            file.flush()
+            os.fsync(file.fileno())
+        with open(index_path(session_id), 'ab') as file:
+            file.write(b''.join(_OFFSET.pack(offset) for offset in new_offsets))
+            file.flush()
+            os.fsync(file.fileno())
+        if not offsets:
+            _fsync_dir(HISTORY_DIR)
+        _appends_since_compaction[session_id] += 1
+        due = _appends_since_compaction[session_id] >= COMPACT_EVERY
+    if due:
+        compact(session_id)
+    return len(offsets) + len(new_offsets)
+
+
+def entry_count(session_id):
+    with _locks[session_id]:
+        return len(_load_index(session_id))
+
+
+def read_entries(session_id, tail=None, start=None, stop=None):
+    """Reads entries from the session log.
+
+    With `tail`, only the last `tail` entries are read; otherwise the slice
+    `start:stop`. Only the requested byte range of the log is touched.
+    Corrupt lines are skipped.
+    """
+    with _locks[session_id]:
+        offsets = _load_index(session_id)
+        if not offsets:
+            return []
+        if tail is not None:
+            start, stop = max(len(offsets) - tail, 0), None
+        selected = offsets[start:stop]
+        if not selected:
+            return []
+        entries = []
+        with open(log_path(session_id), 'rb') as file:
+            file.seek(selected[0])
+            for _ in selected:
+                line = file.readline()
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logger.warning(f"Skipping corrupt history line in {log_path(session_id)}")
+        return entries
+
+
+def write_entries(session_id, entries):
+    """Replaces the whole session log, e.g. when saving a rebuilt history."""
+    with _locks[session_id]:
+        _write_all(session_id, entries)
+        _appends_since_compaction.pop(session_id, None)
+
+
+def compact(session_id):
+    """Rewrites the session log without corrupt lines. Opening the log has
+    already repaired its tail and index, so a log with no corrupt lines is
+    left as it is."""
+    with _locks[session_id]:
+        _appends_since_compaction.pop(session_id, None)
+        offsets = _load_index(session_id)
+        if not offsets:
+            return
+        entries = []
+        with open(log_path(session_id), 'rb') as file:
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+        if len(entries) == len(offsets):
+            return
+        _write_all(session_id, entries)
+    logger.info(f"Compacted history for session {session_id} "
+                f"({len(offsets) - len(entries)} corrupt lines dropped, {len(entries)} entries)")
+
+
+def close(session_id):
+    """Compacts the log of a finished chat and forgets the session's lock,
+    so a long-running server does not keep one per chat it ever served."""
+    compact(session_id)
+    _locks.pop(session_id, None)
+
+
+def list_sessions():
+    if not os.path.exists(HISTORY_DIR):
+        return []
+    session_ids = set()
+    for name in os.listdir(HISTORY_DIR):
+        if name.startswith('conversation_') and name.endswith(('.json', '.jsonl')):
+            session_ids.add(name[len('conversation_'):].rsplit('.', 1)[0])
+    return sorted(session_ids)
@@ -0,0 +1,255 @@
+"""Map-reduce analysis of very large or multi-volume reports.
+
+A report pack that is too long to send whole (more than MAPREDUCE_MIN_PAGES
+pages in total, or several PDFs in one message) is split into page-range
+shards of MAPREDUCE_SHARD_PAGES pages. Each shard's text is analyzed on its
+own, concurrently, into finding records plus notes relevant to the
+question (the map step). The findings are merged and deduplicated locally
+and the model writes one ranked answer from them (the reduce step).
+
+Shard results are stored under MAPREDUCE_DIR by report content hash, page
+range, question and model, so asking again only redoes the shards that
+failed. Shards are built from the page text in the report index, so this
+needs `pip install pypdf` and reports with a text layer.
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass, asdict
+
+import report_index
+from findings import Finding, SEVERITY_RANK, EXTRACTION_PROMPT
+from answer_cache import normalize_prompt, model_fingerprint
+from model_client import client
+from scheduler import scheduler
+from metrics import registry, record_usage
+
+logger = logging.getLogger(__name__)
+
+# auto shards large or multi-file uploads, always shards every upload, off
+# keeps the whole-file path.
+MAPREDUCE_MODE = os.environ.get("MAPREDUCE_MODE", "auto").lower()
+MIN_PAGES = int(os.environ.get("MAPREDUCE_MIN_PAGES", "80"))
+SHARD_PAGES = int(os.environ.get("MAPREDUCE_SHARD_PAGES", "25"))
+SHARD_DIR = os.environ.get("MAPREDUCE_DIR", os.path.join("cache", "shards"))
+
+MAP_GENERATION_CONFIG = {"temperature": 0, "response_mime_type": "application/json"}
+MAP_PROMPT = EXTRACTION_PROMPT.replace("attached report", "report pages below") + """
+If the pages hold no findings, return an empty array. You may instead return an object
+{"findings": [...], "notes": "..."} where notes are short points from these pages that help
+answer the question below, citing pages as [Page N].
+
+Question: """
+
+REDUCE_PROMPT = """The reports were too long to read in one pass, so they were split into sections and
+the findings of every section were extracted, merged and deduplicated. Answer the question below
+from these findings and section notes as one ranked answer, most important first. Cite the
+report and pages for each point. Say so if some sections could not be analyzed."""
+
+SHARDS = registry.counter(
+    "cyberinsight_mapreduce_shards",
+    "Report shards by map step outcome: analyzed, cached or failed.",
+    ["outcome"])
+
+
+@dataclass(frozen=True)
+class Shard:
+    digest: str
+    display_name: str
+    first_page: int
+    last_page: int
+
+    @property
+    def label(self):
+        return f"{self.display_name} pages {self.first_page}-{self.last_page}"
+
+
+def should_shard(indexes):
+    """Whether an upload of these report indexes goes through map-reduce."""
+    if MAPREDUCE_MODE == "off" or not indexes:
+        return False
+    if any(index is None or not index.has_text for index in indexes):
+        return False
+    if MAPREDUCE_MODE == "always":
+        return True
+    return len(indexes) > 1 or sum(len(index.pages) for index in indexes) > MIN_PAGES
+
+
+def plan_shards(reports, shard_pages=SHARD_PAGES):
+    """Splits (display_name, index) pairs into page-range shards."""
+    shards = []
+    for display_name, index in reports:
+        for first in range(0, len(index.pages), shard_pages):
+            last = min(first + shard_pages, len(index.pages))
+            shards.append(Shard(index.digest, display_name, first + 1, last))
+    return shards
+
+
+def shard_text(shard):
+    index = report_index.load(shard.digest)
+    pages = index.pages[shard.first_page - 1:shard.last_page]
+    return '\n\n'.join(f"[Page {shard.first_page + offset}]\n{' '.join(text.split())}"
+                       for offset, text in enumerate(pages))
+
+
+def shard_key(shard, question, model_name):
+    fingerprint = model_fingerprint(model_name, MAP_GENERATION_CONFIG, MAP_PROMPT)
+    payload = json.dumps([shard.digest, shard.first_page, shard.last_page,
+                          normalize_prompt(question), fingerprint])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def shard_path(key):
+    return os.path.join(SHARD_DIR, f'{key}.json')
+
+
+def load_shard_result(key):
+    path = shard_path(key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except ValueError:
+        logger.warning(f"Ignoring unreadable shard result {path}")
+        return None
+
+
+def save_shard_result(key, result):
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    tmp_path = shard_path(key) + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(result, file)
+    os.replace(tmp_path, shard_path(key))
+
+
+def map_shard(shard, question, model_name):
+    """Analyzes one shard with one model call. Blocking; run it on the
+    scheduler. Returns {'findings': [...], 'notes': str}."""
+    model = client.generative_model(model_name=model_name, generation_config=MAP_GENERATION_CONFIG)
+    response = model.generate_content([
+        f"Pages {shard.first_page}-{shard.last_page} of the audit report '{shard.display_name}':",
+        shard_text(shard),
+        MAP_PROMPT + question,
+    ])
+    record_usage(getattr(response, 'usage_metadata', None), model_name)
+    data = json.loads(response.text)
+    notes = ''
+    if isinstance(data, dict):
+        notes = str(data.get('notes') or '')
+        data = data.get('findings', [])
+    records = [asdict(Finding.from_dict(record)) for record in data if isinstance(record, dict)]
+    return {'findings': records, 'notes': notes}
+
+
+async def run_map(shards, question, model_name, session_id=None, on_progress=None):
+    """Runs the map step over `shards` concurrently through the scheduler.
+
+    Stored results are reused; only missing or previously failed shards
+    call the model. `on_progress(done, total, cached, failed)` is awaited
+    after each shard. Returns (results, failed): results maps each
+    analyzed shard to its result, failed lists the shards that errored.
+    """
+    results = {}
+    failed = []
+    cached = 0
+
+    async def run(shard):
+        nonlocal cached
+        key = shard_key(shard, question, model_name)
+        result = await asyncio.to_thread(load_shard_result, key)
+        if result is not None:
+            cached += 1
+            SHARDS.inc(outcome="cached")
+        else:
+            try:
+                result = await scheduler.run(session_id, map_shard, shard, question, model_name)
+            except Exception as e:
+                logger.warning(f"Map step failed for {shard.label}: {str(e)}")
+                SHARDS.inc(outcome="failed")
+                failed.append(shard)
+            else:
+                await asyncio.to_thread(save_shard_result, key, result)
+                SHARDS.inc(outcome="analyzed")
+        if result is not None:
+            results[shard] = result
+        if on_progress is not None:
+            await on_progress(len(results) + len(failed), len(shards), cached, len(failed))
+
+    started = time.monotonic()
+    await asyncio.gather(*(run(shard) for shard in shards))
+    logger.info(f"Map step over {len(shards)} shards took {time.monotonic() - started:.1f}s "
+                f"({cached} cached, {len(failed)} failed)")
+    return results, failed
+
+
+def _title_key(title):
+    return ' '.join(re.findall(r'[a-z0-9]+', title.lower()))
+
+
+def merge_findings(results):
+    """Merges the findings of all shards, one record per distinct title.
+
+    Duplicates (a finding summarized in an executive summary and described
+    again in its own section, or repeated across volumes) keep the most
+    severe rating and the first value of every other field. Returns
+    (finding, sources) pairs ranked by severity, then priority, where
+    sources lists "report p. N" citations.
+    """
+    merged = {}
+    for shard in sorted(results, key=lambda shard: (shard.display_name, shard.first_page)):
+        for record in results[shard]['findings']:
+            finding = Finding.from_dict(record)
+            key = _title_key(finding.title) or f"{shard.digest}:{finding.id}"
+            source = (f"{shard.display_name} p. {finding.page}" if finding.page
+                      else shard.label)
+            if key not in merged:
+                merged[key] = (finding, [source])
+                continue
+            kept, sources = merged[key]
+            if source not in sources:
+                sources.append(source)
+            if SEVERITY_RANK.get((finding.severity or '').lower(), 99) < \
+                    SEVERITY_RANK.get((kept.severity or '').lower(), 99):
+                kept.severity = finding.severity
+            if finding.priority is not None and (kept.priority is None or finding.priority < kept.priority):
+                kept.priority = finding.priority
+            for field in ('recommendation', 'deadline', 'owner', 'page'):
+                if getattr(kept, field) is None:
+                    setattr(kept, field, getattr(finding, field))
+
+    def rank(item):
+        finding = item[0]
+        return (SEVERITY_RANK.get((finding.severity or '').lower(), 99),
+                finding.priority if finding.priority is not None else 99)
+    return sorted(merged.values(), key=rank)
+
+
+def reduce_prompt(question, results, failed):
+    """The text sent to the model for the reduce step."""
+    merged = merge_findings(results)
+    lines = [REDUCE_PROMPT, '', f"Merged findings ({len(merged)}, most severe first):"]
+    for number, (finding, sources) in enumerate(merged, 1):
+        rating = ', '.join(value for value in (
+            finding.severity, f"priority {finding.priority}" if finding.priority is not None else None,
+            f"due {finding.deadline}" if finding.deadline else None,
+            f"owner {finding.owner}" if finding.owner else None) if value)
+        lines.append(f"{number}. {finding.title} ({rating or 'unrated'}) [{'; '.join(sources)}]")
+        if finding.recommendation:
+            lines.append(f"   Recommendation: {finding.recommendation}")
+    notes = [(shard, results[shard]['notes']) for shard in
+             sorted(results, key=lambda shard: (shard.display_name, shard.first_page))
+             if results[shard]['notes']]
+    if notes:
+        lines.extend(['', "Section notes:"])
+        lines.extend(f"- {shard.label}: {text}" for shard, text in notes)
+    if failed:
+        lines.extend(['', "Sections that could not be analyzed: "
+                      + '; '.join(shard.label for shard in failed)])
+    lines.extend(['', f"Question: {question}"])
+    return '\n'.join(lines)
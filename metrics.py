@@ -0,0 +1,273 @@
+"""Per-stage tracing spans, token counters and a Prometheus-style endpoint.
+
+Each stage of a request (upload, readiness wait, history load, model call,
+history save, UI send) runs inside `span()`, which records its duration in a
+histogram and emits one structured log line at DEBUG. Token usage is taken
+from the response usage metadata. Everything is exported in the Prometheus
+text format from a small HTTP server on METRICS_HOST:METRICS_PORT (default
+127.0.0.1:9464, METRICS_PORT=0 disables it).
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+# Fraction of model responses whose full text is logged; 0 logs only sizes.
+RESPONSE_LOG_SAMPLE_RATE = float(os.environ.get("RESPONSE_LOG_SAMPLE_RATE", "0"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _label_text(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}_total{_label_text(self.labelnames, key)} {_number(value)}"
+                for key, value in values]
+
+
+class Gauge:
+    """Reads its value from `fn` at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, fn):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+
+    def render(self):
+        try:
+            return [f"{self.name} {_number(self.fn())}"]
+        except Exception as e:
+            logger.warning(f"Gauge {self.name} failed: {str(e)}")
+            return []
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        with self._lock:
+            series = sorted((key, dict(value, counts=list(value['counts'])))
+                            for key, value in self._series.items())
+        lines = []
+        for key, value in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, value['counts']):
+                cumulative += count
+                labels = _label_text(self.labelnames, key, ("le", _number(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _label_text(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_number(value['sum'])}")
+            lines.append(f"{self.name}_count{labels} {value['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            # Re-registering (e.g. a module reloaded by Chainlit's watcher)
+            # replaces the old metric instead of duplicating it.
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, fn):
+        return self._register(Gauge(name, documentation, fn))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "cyberinsight_stage_duration_seconds",
+    "Time spent in each stage of handling a message.",
+    ["stage", "outcome"])
+TIME_TO_FIRST_TOKEN = registry.histogram(
+    "cyberinsight_time_to_first_token_seconds",
+    "Time from sending a streamed request to receiving its first token.",
+    ["model"])
+TOKENS = registry.counter(
+    "cyberinsight_tokens",
+    "Tokens reported in response usage metadata.",
+    ["model", "kind"])
+RESPONSES = registry.counter(
+    "cyberinsight_responses",
+    "Answers sent to users, by where the answer came from.",
+    ["source"])
+
+
+@contextmanager
+def span(stage, session_id=None, **attributes):
+    """Times the enclosed block as `stage`.
+
+    Yields a dict that the block may add attributes to; they end up in the
+    span's log line. Exceptions are recorded with outcome "error" (or
+    "cancelled") and re-raised.
+    """
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield attributes
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage, outcome=outcome)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps({'span': stage, 'session_id': session_id,
+                                     'duration_s': round(elapsed, 4), 'outcome': outcome,
+                                     **attributes}, default=str))
+
+
+def record_usage(usage_metadata, model_name):
+    """Adds a response's token counts to the token counters."""
+    if usage_metadata is None:
+        return
+    for kind, field in (('prompt', 'prompt_token_count'),
+                        ('output', 'candidates_token_count'),
+                        ('total', 'total_token_count')):
+        count = getattr(usage_metadata, field, 0) or 0
+        if count:
+            TOKENS.inc(count, model=model_name, kind=kind)
+
+
+def log_response(log, text, source="model"):
+    """Logs a response's size, and its full text for a sampled fraction."""
+    RESPONSES.inc(source=source)
+    if RESPONSE_LOG_SAMPLE_RATE > 0 and random.random() < RESPONSE_LOG_SAMPLE_RATE:
+        log.info(f"Received response ({source}): {text}")
+    else:
+        log.info(f"Received response ({source}): {len(text)} characters")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serves /metrics from a daemon thread. Safe to call more than once."""
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is not None:
+            return _server or None
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            # Usually another worker already owns the port; don't retry.
+            _server = False
+            logger.warning(f"Metrics endpoint not started on {host}:{port}: {str(e)}")
+            return None
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return _server
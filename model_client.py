@@ -0,0 +1,79 @@
+"""The one place the app talks to the model API.
+
+Everything that uploads files, checks their state or starts chats goes
+through `client`, so the real Gemini backend can be swapped for the local
+stand-in in `fake_backend.py` (MODEL_BACKEND=fake) for benchmarks and load
+tests that must not spend API quota.
+"""
+
+import os
+import logging
+import threading
+from abc import ABC, abstractmethod
+
+from dotenv import load_dotenv
+import google.generativeai as genai
+
+logger = logging.getLogger(__name__)
+
+MODEL_BACKEND = os.environ.get("MODEL_BACKEND", "gemini").lower()
+
+
+class ModelClient(ABC):
+    @abstractmethod
+    def upload_file(self, path, mime_type=None):
+        ...
+
+    @abstractmethod
+    def get_file(self, name):
+        ...
+
+    @abstractmethod
+    def generative_model(self, **kwargs):
+        """Returns a model object with `model_name`, `generate_content` and
+        `start_chat`, built from GenerativeModel keyword arguments."""
+
+    def start_chat(self, model, history=None):
+        return model.start_chat(history=history or [])
+
+
+class GeminiClient(ModelClient):
+    """Configures the SDK with GEMINI_API_KEY on first use, not on import."""
+
+    def __init__(self):
+        self._configured = False
+        self._lock = threading.Lock()
+
+    def configure(self):
+        if self._configured:
+            return
+        with self._lock:
+            if not self._configured:
+                load_dotenv()
+                genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+                self._configured = True
+
+    def upload_file(self, path, mime_type=None):
+        self.configure()
+        return genai.upload_file(path, mime_type=mime_type)
+
+    def get_file(self, name):
+        self.configure()
+        return genai.get_file(name)
+
+    def generative_model(self, **kwargs):
+        self.configure()
+        return genai.GenerativeModel(**kwargs)
+
+
+def create_client(backend=MODEL_BACKEND):
+    if backend == "fake":
+        from fake_backend import FakeClient
+        logger.warning("Using the fake model backend, no requests reach the Gemini API")
+        return FakeClient.from_env()
+    if backend != "gemini":
+        raise ValueError(f"Unknown MODEL_BACKEND '{backend}', expected 'gemini' or 'fake'")
+    return GeminiClient()
+
+
+client = create_client()
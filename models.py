@@ -0,0 +1,89 @@
+"""Shared model configuration and a lazily built model registry.
+
+Every entry point used to build its own GenerativeModel, with its own copy
+of the generation config and system instruction, at import time. Models are
+now registered here by name and only constructed the first time `get_model`
+is called, so importing an app does no configuration, network or quota work.
+"""
+
+import os
+import threading
+
+from model_client import client
+
+MODEL_NAME = "gemini-1.5-pro-exp-0827"
+# Cheap tier for reformatting, lookups and short follow-ups, see router.py
+FAST_MODEL_NAME = os.environ.get("ROUTER_FAST_MODEL", "gemini-1.5-flash-002")
+
+GENERATION_CONFIG = {
+    "temperature": 0.1,
+    "top_p": 0.95,
+    "top_k": 64,
+    "max_output_tokens": 100000,
+    "response_mime_type": "text/plain",
+}
+
+SYSTEM_INSTRUCTION = '''
+    You’re a highly skilled cybersecurity analyst with a deep understanding of unstructured data analysis and natural language processing. You have been working in the field for over 15 years, specializing in interpreting and synthesizing complex cybersecurity audit reports into clear, actionable insights. Your expertise allows you to facilitate effective communication on cybersecurity issues through intuitive, chat-based interaction.
+
+    Your task is to analyze unstructured cybersecurity audit reports attached and provide chat-based responses to decision-related questions. Here are the details you need to keep in mind:  
+    - Unstructured audit report content
+    - Specific questions or decision points to address
+    - Key metrics or insights to highlight
+    - Audience for the chat-based output
+
+    Remember, your goal is to leverage machine learning algorithms and NLP capabilities to not only interpret the reports but also to summarize findings and present actionable insights that streamline the decision-making process efficiently. Always remember to format the text in the type requested by the user like: Bulletted List, Table or Tabular, csv, json, etc.
+    
+    Take a deep breath and answer the query, thinking it through step-by-step.
+    '''
+
+FAST_GENERATION_CONFIG = dict(GENERATION_CONFIG, max_output_tokens=8192)
+
+ANALYST = "analyst"
+FAST = "fast"
+
+_specs = {
+    ANALYST: {
+        'model_name': MODEL_NAME,
+        'generation_config': GENERATION_CONFIG,
+        'system_instruction': SYSTEM_INSTRUCTION,
+        'tools': 'code_execution',
+    },
+    FAST: {
+        'model_name': FAST_MODEL_NAME,
+        'generation_config': FAST_GENERATION_CONFIG,
+        'system_instruction': SYSTEM_INSTRUCTION,
+    },
+}
+_models = {}
+_lock = threading.Lock()
+
+
+def register(name, **kwargs):
+    """Registers (or replaces) the GenerativeModel arguments for `name`."""
+    with _lock:
+        _specs[name] = kwargs
+        _models.pop(name, None)
+
+
+def spec(name=ANALYST):
+    return dict(_specs[name])
+
+
+def qualified_name(name=ANALYST):
+    """The API model name, as `model.model_name` reports it, without building
+    the model."""
+    model_name = _specs[name]['model_name']
+    return model_name if '/' in model_name else f"models/{model_name}"
+
+
+def get_model(name=ANALYST):
+    """Returns the model registered as `name`, building it on first use."""
+    model = _models.get(name)
+    if model is not None:
+        return model
+    with _lock:
+        model = _models.get(name)
+        if model is None:
+            model = _models[name] = client.generative_model(**_specs[name])
+        return model
@@ -0,0 +1,263 @@
+"""Compact per-report digests for comparison and portfolio questions.
+
+Comparing reports used to mean re-reading every PDF through the model. Each
+report now gets a small digest, built locally from its extracted findings
+(see findings.py): finding counts by priority and severity, findings per
+control area and the top findings. Digests are stored by content hash under
+REPORT_DIGEST_DIR, together with the findings file's modification time, and
+are only rebuilt when the findings change or the digest format does; a
+changed report has a new hash and gets its own digest. Questions that
+compare reports are then answered over the digests alone.
+
+Build digests for reports extracted before this existed with:
+
+$ python report_digest.py rebuild
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import threading
+from dataclasses import dataclass, asdict, field
+
+import findings
+
+logger = logging.getLogger(__name__)
+
+DIGEST_DIR = os.environ.get("REPORT_DIGEST_DIR", os.path.join("cache", "digests"))
+TOP_FINDINGS = int(os.environ.get("REPORT_DIGEST_TOP", "5"))
+# Most reports a portfolio question is answered over, newest digests first.
+PORTFOLIO_MAX = int(os.environ.get("REPORT_DIGEST_PORTFOLIO_MAX", "10"))
+# Bump when the digest layout changes so stored digests get rebuilt.
+DIGEST_VERSION = 1
+
+CONTROL_AREAS = [
+    ("Governance and resourcing", r'governance|polic(y|ies)|strategy|resourc|staff|board|oversight|'
+                                  r'risk (management|register)|framework|roles?'),
+    ("Awareness and training", r'awareness|training|phishing|culture'),
+    ("Identity and access", r'access|privileged|admin|accounts?|passwords?|authenticat|mfa|'
+                            r'identity|leavers?|joiners?'),
+    ("Patching and vulnerabilities", r'patch|vulnerab|unsupported|legacy|end of life|penetration'),
+    ("Network and perimeter", r'network|firewall|perimeter|segment|remote|vpn|wireless|wi-?fi'),
+    ("Third parties", r'third[- ]part|suppliers?|vendors?|contract|outsourc|providers?'),
+    ("Monitoring and incidents", r'monitor|logging|logs?\b|incident|siem|detect'),
+    ("Backup and continuity", r'backup|recovery|continuity|disaster|resilien'),
+    ("Data protection", r'\bdata\b|encrypt|classification|gdpr|retention|removable|usb'),
+    ("Assets and configuration", r'assets?|inventory|configuration|baseline|harden|devices?|'
+                                 r'endpoints?|antivirus|malware'),
+]
+OTHER_AREA = "Other"
+_AREAS = [(name, re.compile(pattern)) for name, pattern in CONTROL_AREAS]
+
+_COMPARISON = re.compile(
+    r'\b(compare|comparison|comparing|contrast|versus|vs|benchmark|portfolio|'
+    r'across (the |all |these |both |our )?(reports|audits|councils|organi[sz]ations)|'
+    r'(all|both|each) (of )?(the |these |our )?(reports|audits|councils)|'
+    r'which (report|audit|council|organi[sz]ation)s?|common (issues|findings|themes))\b')
+# Words in report file names that say nothing about which report it is.
+_GENERIC_NAME_WORDS = frozenset("""
+pdf report audit audits cyber security cybersecurity internal final draft the of and
+city council borough county review assessment it information v1 v2 v3
+""".split())
+
+COMPARISON_PROMPT = """Digests of the audit reports involved are below: finding counts, findings per control
+area and the top findings of each. Answer the question by comparing the reports on these digests.
+Name the report for every point, and say so if a digest does not hold what the question needs."""
+
+
+@dataclass
+class ReportDigest:
+    digest: str
+    display_name: str
+    findings_total: int
+    by_priority: dict
+    by_severity: dict
+    control_areas: dict
+    top_findings: list
+    source_mtime: float = 0.0
+    built_at: float = 0.0
+    version: int = DIGEST_VERSION
+    name_words: list = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+def control_area(finding):
+    text = f"{finding.title} {finding.recommendation or ''}".lower()
+    return next((name for name, pattern in _AREAS if pattern.search(text)), OTHER_AREA)
+
+
+def name_words(display_name):
+    stem = os.path.splitext(display_name)[0].lower()
+    return sorted({word for word in re.findall(r'[a-z]+', stem)
+                   if len(word) > 2 and word not in _GENERIC_NAME_WORDS})
+
+
+def _rank(finding):
+    return (findings.SEVERITY_RANK.get((finding.severity or '').lower(), 99),
+            finding.priority if finding.priority is not None else 99)
+
+
+def _counts(values):
+    counts = {}
+    for value in values:
+        label = 'Unrated' if value is None else str(value)
+        counts[label] = counts.get(label, 0) + 1
+    return dict(sorted(counts.items()))
+
+
+def build(digest, display_name, records, source_mtime=0.0):
+    """Builds the digest of one report from its finding records."""
+    areas = [control_area(finding) for finding in records]
+    ranked = sorted(zip(records, areas), key=lambda item: _rank(item[0]))
+    area_counts = {}
+    for area in areas:
+        area_counts[area] = area_counts.get(area, 0) + 1
+    return ReportDigest(
+        digest=digest,
+        display_name=display_name,
+        findings_total=len(records),
+        by_priority=_counts(finding.priority for finding in records),
+        by_severity=_counts(finding.severity for finding in records),
+        control_areas=dict(sorted(area_counts.items(), key=lambda item: -item[1])),
+        top_findings=[{'id': finding.id, 'title': finding.title, 'priority': finding.priority,
+                       'severity': finding.severity, 'area': area}
+                      for finding, area in ranked[:TOP_FINDINGS]],
+        source_mtime=source_mtime,
+        built_at=time.time(),
+        name_words=name_words(display_name),
+    )
+
+
+def digest_path(digest):
+    return os.path.join(DIGEST_DIR, f'{digest}.json')
+
+
+def load_digest(digest):
+    path = digest_path(digest)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as file:
+            return ReportDigest.from_dict(json.load(file))
+    except (ValueError, TypeError):
+        logger.warning(f"Ignoring unreadable report digest {path}")
+        return None
+
+
+def save_digest(report):
+    os.makedirs(DIGEST_DIR, exist_ok=True)
+    tmp_path = digest_path(report.digest) + f'.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(asdict(report), file)
+    os.replace(tmp_path, digest_path(report.digest))
+
+
+def ensure_digest(digest, display_name=None):
+    """Returns the digest of a report, building it only if it is missing or
+    older than the report's findings. Returns None if the report's findings
+    have not been extracted yet. Blocking."""
+    stored = load_digest(digest)
+    path = findings.findings_path(digest)
+    if not os.path.exists(path):
+        return stored
+    mtime = os.path.getmtime(path)
+    if stored is not None and stored.version == DIGEST_VERSION and stored.source_mtime >= mtime:
+        return stored
+    records = findings.load_findings(digest)
+    name = display_name or (stored.display_name if stored else digest[:12])
+    report = build(digest, name, records, mtime)
+    save_digest(report)
+    logger.info(f"Built digest of report {name} ({digest[:12]}): {report.findings_total} findings")
+    return report
+
+
+def list_digests():
+    if not os.path.isdir(DIGEST_DIR):
+        return []
+    reports = []
+    for name in sorted(os.listdir(DIGEST_DIR)):
+        if name.endswith('.json'):
+            report = load_digest(name[:-len('.json')])
+            if report is not None:
+                reports.append(report)
+    return reports
+
+
+def is_comparison(text):
+    return bool(_COMPARISON.search(' '.join(text.lower().split())))
+
+
+def comparison_digests(question, session_reports=()):
+    """Picks the digests a comparison question is about: reports named in
+    the question plus the session's own reports (dicts with 'digest' and
+    'display_name'). If that is fewer than two, the question is taken to be
+    about the portfolio: the session's reports and the most recently built
+    digests, up to PORTFOLIO_MAX in all.
+
+    Returns an empty list if a session report has no digest yet (its
+    findings are still being extracted, or extraction failed), so the
+    question is not answered without it. Blocking."""
+    own = [ensure_digest(ref['digest'], ref['display_name']) for ref in session_reports]
+    missing = [ref['display_name'] for ref, report in zip(session_reports, own) if report is None]
+    if missing:
+        logger.info(f"No digest yet for {', '.join(missing)}, not comparing over digests")
+        return []
+    everything = {report.digest: report for report in list_digests()}
+    everything.update((report.digest, report) for report in own)
+    words = set(re.findall(r'[a-z]+', question.lower()))
+    selected = {report.digest: report for report in own}
+    selected.update((report.digest, report) for report in everything.values()
+                    if words.intersection(report.name_words))
+    if len(selected) < 2:
+        others = sorted((report for digest, report in everything.items() if digest not in selected),
+                        key=lambda report: -report.built_at)
+        selected.update((report.digest, report)
+                        for report in others[:max(PORTFOLIO_MAX - len(selected), 0)])
+    return sorted(selected.values(), key=lambda report: report.display_name)
+
+
+def render(reports):
+    """Renders digests as the compact text sent with a comparison question."""
+    blocks = [COMPARISON_PROMPT]
+    for report in reports:
+        counts = '; '.join(
+            f"{label}: " + ', '.join(f"{key} {value}" for key, value in values.items())
+            for label, values in (("by priority", report.by_priority),
+                                  ("by severity", report.by_severity)) if values)
+        lines = [f"Report '{report.display_name}': {report.findings_total} findings ({counts})",
+                 "Control areas: " + ', '.join(f"{area} {count}"
+                                               for area, count in report.control_areas.items())]
+        for finding in report.top_findings:
+            rating = ', '.join(str(value) for value in (
+                finding['severity'],
+                f"priority {finding['priority']}" if finding['priority'] is not None else None)
+                if value)
+            lines.append(f"- {finding['title']} ({rating or 'unrated'}; {finding['area']})")
+        blocks.append('\n'.join(lines))
+    return '\n\n'.join(blocks)
+
+
+def rebuild():
+    """Builds or refreshes digests for every report with stored findings."""
+    if not os.path.isdir(findings.FINDINGS_DIR):
+        return 0
+    count = 0
+    for name in sorted(os.listdir(findings.FINDINGS_DIR)):
+        if name.endswith('.json'):
+            ensure_digest(name[:-len('.json')])
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python report_digest.py rebuild")
+        sys.exit(2)
+    print(f"{rebuild()} report digests up to date in {DIGEST_DIR}")
@@ -0,0 +1,176 @@
+"""Local per-page text index of audit reports.
+
+Pages are extracted once per report (keyed by content hash), scored with
+BM25 and stored on disk, so follow-up questions can send the model only the
+few pages that matter instead of the whole PDF.
+
+Needs `pip install pypdf`; without it the app stays in whole-file mode.
+"""
+
+import os
+import re
+import json
+import math
+import logging
+import threading
+from collections import Counter, OrderedDict
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # pragma: no cover - optional dependency
+    PdfReader = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIR = os.environ.get("REPORT_INDEX_DIR", os.path.join("cache", "reports"))
+# "retrieval" sends the top pages with each follow-up, "whole_file" keeps
+# the PDF attached to the conversation as before.
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "retrieval").lower()
+TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "5"))
+PASSAGE_CHARS = 3000
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_STOPWORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or that the
+this to was were will with which what who how can should into their there
+these those not no than then them they we you your our all any also
+""".split())
+
+_loaded = OrderedDict()
+_loaded_lock = threading.Lock()
+_MAX_LOADED = 32
+
+
+def retrieval_enabled():
+    return RETRIEVAL_MODE == "retrieval" and PdfReader is not None
+
+
+def tokenize(text):
+    return [token for token in re.findall(r'[a-z0-9]+', text.lower())
+            if token not in _STOPWORDS and len(token) > 1]
+
+
+def extract_pages(path):
+    reader = PdfReader(path)
+    pages = []
+    for page in reader.pages:
+        try:
+            pages.append(page.extract_text() or '')
+        except Exception as e:
+            logger.warning(f"Could not extract text from a page of {path}: {str(e)}")
+            pages.append('')
+    return pages
+
+
+class ReportIndex:
+    def __init__(self, digest, pages, term_freqs, doc_freqs):
+        self.digest = digest
+        self.pages = pages
+        self.term_freqs = term_freqs
+        self.doc_freqs = doc_freqs
+        self.lengths = [sum(freqs.values()) for freqs in term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+    @classmethod
+    def build(cls, digest, pages):
+        term_freqs = [dict(Counter(tokenize(text))) for text in pages]
+        doc_freqs = Counter()
+        for freqs in term_freqs:
+            doc_freqs.update(freqs.keys())
+        return cls(digest, pages, term_freqs, dict(doc_freqs))
+
+    @property
+    def has_text(self):
+        return any(self.lengths)
+
+    def search(self, query, k=TOP_K):
+        """Returns up to `k` (page_number, score, text) tuples, best first."""
+        terms = set(tokenize(query))
+        total = len(self.pages)
+        scores = []
+        for page_no, freqs in enumerate(self.term_freqs):
+            score = 0.0
+            length_norm = 1 - BM25_B + BM25_B * self.lengths[page_no] / (self.avg_length or 1)
+            for term in terms:
+                tf = freqs.get(term)
+                if not tf:
+                    continue
+                df = self.doc_freqs[term]
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+            if score > 0:
+                scores.append((score, page_no))
+        scores.sort(reverse=True)
+        return [(page_no + 1, score, self.pages[page_no]) for score, page_no in scores[:k]]
+
+    def leading_pages(self, k=TOP_K):
+        """The first `k` pages with text, in `search`'s format, for questions
+        that match no page."""
+        pages = [(page_no + 1, 0.0, self.pages[page_no])
+                 for page_no, length in enumerate(self.lengths) if length]
+        return pages[:k]
+
+    def to_dict(self):
+        return {'digest': self.digest, 'pages': self.pages,
+                'term_freqs': self.term_freqs, 'doc_freqs': self.doc_freqs}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['digest'], data['pages'], data['term_freqs'], data['doc_freqs'])
+
+
+def index_path(digest):
+    return os.path.join(INDEX_DIR, f'{digest}.json')
+
+
+def _remember(index):
+    with _loaded_lock:
+        _loaded[index.digest] = index
+        _loaded.move_to_end(index.digest)
+        while len(_loaded) > _MAX_LOADED:
+            _loaded.popitem(last=False)
+    return index
+
+
+def load(digest):
+    """Returns the stored index for `digest`, or None if it was never built."""
+    with _loaded_lock:
+        index = _loaded.get(digest)
+    if index is not None:
+        return index
+    path = index_path(digest)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        return _remember(ReportIndex.from_dict(json.load(file)))
+
+
+def load_or_build(path, digest):
+    """Extracts and indexes `path` unless an index for its content already exists."""
+    index = load(digest)
+    if index is not None:
+        return index
+    pages = extract_pages(path)
+    index = ReportIndex.build(digest, pages)
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    # Two sessions may index the same report at once; don't share a temp file.
+    tmp_path = index_path(digest) + f'.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(index.to_dict(), file)
+    os.replace(tmp_path, index_path(digest))
+    logger.info(f"Indexed {len(pages)} pages of {path} as {digest[:12]}")
+    return _remember(index)
+
+
+def format_passages(hits, report_name):
+    """Renders search hits as cited excerpts to prepend to a question."""
+    if not hits:
+        return ''
+    lines = [f"Relevant excerpts from the report '{report_name}':"]
+    for page_no, _, text in sorted(hits):
+        text = ' '.join(text.split())[:PASSAGE_CHARS]
+        lines.append(f"[Page {page_no}] {text}")
+    lines.append("Cite page numbers as [Page N] when you rely on an excerpt.")
+    return '\n\n'.join(lines)
@@ -0,0 +1,167 @@
+"""Routes each chat request to the fast or the Pro model tier.
+
+Cheap local heuristics decide: the first pass over a newly attached report
+and anything that reads like analysis goes to Pro; reformatting ("make that
+a CSV"), lookups and short follow-ups go to the fast tier. A fast answer
+that fails or comes back empty is retried on Pro. Decisions, escalations
+and per-tier latency are exported as metrics and appended to the JSONL file
+at ROUTER_LOG_PATH (empty disables it) for tuning the thresholds offline.
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass, asdict
+
+import models
+from model_client import client
+from scheduler import scheduler, ServiceOverloaded
+from streaming import STREAM_RESPONSES, stream_response
+from metrics import registry, record_usage
+
+logger = logging.getLogger(__name__)
+
+# auto routes per request; pro or fast pins every request to one tier.
+ROUTER_MODE = os.environ.get("ROUTER_MODE", "auto").lower()
+FAST_MAX_WORDS = int(os.environ.get("ROUTER_FAST_MAX_WORDS", "40"))
+ROUTER_LOG_PATH = os.environ.get("ROUTER_LOG_PATH", os.path.join("cache", "routing.jsonl"))
+
+PRO = "pro"
+FAST = "fast"
+
+ESCALATION_NOTICE = "_Checking with the detailed analysis model…_\n\n"
+
+_REFORMAT = re.compile(
+    r'\b(csv|json|table|tabular|bullet(ed|ted)? ?(list|points)?|markdown|format|reformat|'
+    r'rewrite|rephrase|shorter|shorten|condense|translate|as a list|make (that|it|this)|'
+    r'turn (that|it|this) into|put (that|it|this) (in|into))\b')
+_LOOKUP = re.compile(
+    r'^(what|which|who|when|where|is|are|does|do|did|how many|how much|list|show|give)\b')
+_ANALYSIS = re.compile(
+    r'\b(analy[sz]e|analysis|assess|evaluate|compare|comparison|recommend|strategy|roadmap|'
+    r'plan|prioriti[sz]e|why|implications?|root cause|trade-?offs?|risk assessment|'
+    r'in detail|detailed|thorough|step[- ]by[- ]step|summari[sz]e the (whole|entire) report)\b')
+
+ROUTE_DECISIONS = registry.counter(
+    "cyberinsight_route_decisions",
+    "Requests routed to each model tier, by the rule that decided.",
+    ["tier", "reason"])
+ROUTE_ESCALATIONS = registry.counter(
+    "cyberinsight_route_escalations",
+    "Fast-tier answers retried on the Pro tier, by cause.",
+    ["cause"])
+TIER_SECONDS = registry.histogram(
+    "cyberinsight_tier_latency_seconds",
+    "Model call latency per tier and outcome.",
+    ["tier", "outcome"])
+
+
+@dataclass
+class Route:
+    tier: str
+    reason: str
+    words: int
+
+
+def classify(text, new_report=False):
+    """Picks a tier for `text` from local features only."""
+    question = ' '.join(text.lower().split())
+    words = len(question.split())
+    if ROUTER_MODE in (PRO, FAST):
+        return Route(ROUTER_MODE, "pinned", words)
+    if new_report:
+        return Route(PRO, "first_pass", words)
+    if _ANALYSIS.search(question):
+        return Route(PRO, "analysis", words)
+    if words > FAST_MAX_WORDS:
+        return Route(PRO, "long", words)
+    if _REFORMAT.search(question):
+        return Route(FAST, "reformat", words)
+    if _LOOKUP.search(question):
+        return Route(FAST, "lookup", words)
+    return Route(FAST, "follow_up", words)
+
+
+_log_lock = threading.Lock()
+
+
+def _log_decision(route, outcome, elapsed, escalated):
+    if not ROUTER_LOG_PATH:
+        return
+    record = dict(asdict(route), outcome=outcome, latency_s=round(elapsed, 3),
+                  escalated=escalated, at=time.time())
+    folder = os.path.dirname(ROUTER_LOG_PATH)
+    with _log_lock:
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(ROUTER_LOG_PATH, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+
+
+async def _call(chat_session, content, reply, session_id):
+    if STREAM_RESPONSES:
+        return await stream_response(chat_session, content, reply, session_id=session_id)
+    response = await scheduler.run(session_id, chat_session.send_message, content)
+    record_usage(getattr(response, 'usage_metadata', None), chat_session.model.model_name)
+    return response.text
+
+
+async def send(chat_session, content, route, reply, session_id=None):
+    """Answers `content` on the tier chosen by `route` and returns the text.
+
+    Pro requests run on `chat_session` itself. Fast requests run on a
+    throwaway chat over the same history, whose new exchange is copied back
+    on success. A fast failure or empty answer is retried on Pro. Streamed
+    tokens go to `reply`; without streaming its content is set at the end.
+    Either way the caller still has to send `reply`.
+    """
+    logger.info(f"Routing to {route.tier} ({route.reason}, {route.words} words)")
+    ROUTE_DECISIONS.inc(tier=route.tier, reason=route.reason)
+    escalated = False
+    if route.tier == FAST:
+        fast_chat = client.start_chat(models.get_model(models.FAST), list(chat_session.history))
+        started = time.monotonic()
+        cause = None
+        try:
+            text = await _call(fast_chat, content, reply, session_id)
+            if not text.strip():
+                cause = "empty"
+        except ServiceOverloaded:
+            # Pro would be turned away just the same.
+            raise
+        except Exception as e:
+            logger.warning(f"Fast tier failed, escalating to Pro: {str(e)}")
+            cause = "error"
+        elapsed = time.monotonic() - started
+        TIER_SECONDS.observe(elapsed, tier=FAST, outcome=cause or "ok")
+        if cause is None:
+            await asyncio.to_thread(_log_decision, route, "ok", elapsed, False)
+            chat_session.history = fast_chat.history
+            if not STREAM_RESPONSES:
+                reply.content = text
+            return text
+        ROUTE_ESCALATIONS.inc(cause=cause)
+        await asyncio.to_thread(_log_decision, route, cause, elapsed, True)
+        escalated = True
+        if reply.content:
+            # Replace whatever the fast tier managed to stream.
+            await reply.stream_token(ESCALATION_NOTICE, is_sequence=True)
+            reply.content = ""
+
+    started = time.monotonic()
+    try:
+        text = await _call(chat_session, content, reply, session_id)
+    except Exception:
+        TIER_SECONDS.observe(time.monotonic() - started, tier=PRO, outcome="error")
+        raise
+    elapsed = time.monotonic() - started
+    TIER_SECONDS.observe(elapsed, tier=PRO, outcome="ok")
+    await asyncio.to_thread(_log_decision, Route(PRO, route.reason, route.words),
+                            "ok", elapsed, escalated)
+    if not STREAM_RESPONSES:
+        reply.content = text
+    return text
@@ -0,0 +1,283 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENCY = int(os.environ.get("MODEL_MAX_CONCURRENCY", "8"))
+MIN_CONCURRENCY = int(os.environ.get("MODEL_MIN_CONCURRENCY", "1"))
+RETRY_ATTEMPTS = int(os.environ.get("MODEL_RETRY_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.environ.get("MODEL_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = 16.0
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "8"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "30"))
+# A burst of errors from calls that were in flight together is one signal,
+# so the limit is halved at most once per interval.
+DECREASE_INTERVAL = 1.0
+
+RATE_LIMITED = (exceptions.TooManyRequests, exceptions.ResourceExhausted)
+UNAVAILABLE = (exceptions.ServiceUnavailable, exceptions.InternalServerError,
+               exceptions.BadGateway, exceptions.GatewayTimeout, exceptions.DeadlineExceeded)
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+_BREAKER_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CALLS = registry.counter(
+    "cyberinsight_scheduler_calls",
+    "Model and file API calls by outcome; ok is the goodput.",
+    ["outcome"])
+RETRIES = registry.counter(
+    "cyberinsight_scheduler_retries",
+    "Idempotent calls retried after a rate-limit or unavailable error.",
+    ["call"])
+BREAKER_TRIPS = registry.counter(
+    "cyberinsight_circuit_breaker_trips",
+    "Times the circuit breaker opened.")
+
+
+def error_kind(error):
+    """"rate_limited" or "unavailable" for errors worth retrying, else None."""
+    if isinstance(error, RATE_LIMITED):
+        return "rate_limited"
+    if isinstance(error, UNAVAILABLE):
+        return "unavailable"
+    return None
+
+
+def is_transient(error):
+    return error_kind(error) is not None
+
+
+class ServiceOverloaded(Exception):
+    """Raised instead of calling the API while the circuit breaker is open."""
+
+    def __init__(self, retry_after, queued):
+        self.retry_after = retry_after
+        self.queued = queued
+        super().__init__(
+            f"The analysis service is overloaded, so new requests are paused for about "
+            f"{max(retry_after, 1):.0f}s ({queued} requests in progress or queued). "
+            f"Please try again shortly.")
+
+
+class RequestScheduler:
+    """Runs blocking SDK calls on a thread pool behind a global concurrency limit.
+
+    When every slot is busy, callers queue per session and freed slots are
+    handed out round-robin across sessions, so one chat issuing many calls
+    cannot starve the others.
+
+    The limit adapts (AIMD): it is halved when calls hit rate limits and
+    grows back by about one slot per window of successful calls, up to
+    `max_concurrency`. After BREAKER_FAILURES rate-limit or unavailable
+    errors in a row the circuit breaker opens: queued and new calls
+    fail fast with ServiceOverloaded for BREAKER_COOLDOWN seconds, then a
+    single probe call decides whether to close it again.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, min_concurrency=MIN_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.limit = float(max_concurrency)
+        self.active = 0
+        self.completed = 0
+        self.total_wait_seconds = 0.0
+        self.breaker = CLOSED
+        self._failures = 0
+        self._opened_until = 0.0
+        self._probing = False
+        self._last_decrease = 0.0
+        self._queues = OrderedDict()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="gemini")
+
+    @property
+    def queue_depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def capacity(self):
+        return int(self.limit)
+
+    def _grant(self):
+        while self.active < self.capacity and self._queues:
+            session_id, queue = self._queues.popitem(last=False)
+            waiter = queue.popleft()
+            if queue:
+                # Back of the line until every other session had a turn.
+                self._queues[session_id] = queue
+            if waiter.done():
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+    def _discard(self, session_id, waiter):
+        queue = self._queues.get(session_id)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[session_id]
+
+    async def _acquire(self, session_id):
+        if self.active < self.capacity and not self._queues:
+            self.active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(session_id, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as we were cancelled.
+                self._release()
+            else:
+                self._discard(session_id, waiter)
+            raise
+
+    def _release(self):
+        self.active -= 1
+        self._grant()
+
+    def overloaded(self):
+        return ServiceOverloaded(self._opened_until - time.monotonic(),
+                                 self.active + self.queue_depth)
+
+    def _admit(self):
+        """Raises ServiceOverloaded if the breaker rejects a new call.
+        Returns True if the call is the half-open probe."""
+        if self.breaker == OPEN:
+            if time.monotonic() < self._opened_until:
+                CALLS.inc(outcome="rejected")
+                raise self.overloaded()
+            self.breaker = HALF_OPEN
+        if self.breaker == HALF_OPEN:
+            if self._probing:
+                CALLS.inc(outcome="rejected")
+                raise self.overloaded()
+            self._probing = True
+            return True
+        return False
+
+    def _trip(self):
+        self.breaker = OPEN
+        self._opened_until = time.monotonic() + BREAKER_COOLDOWN
+        BREAKER_TRIPS.inc()
+        logger.warning(f"Circuit breaker open for {BREAKER_COOLDOWN:g}s after "
+                       f"{self._failures} failed calls, {self.queue_depth} queued calls rejected")
+        # Fail the waiting calls now rather than let them hit the API.
+        error = self.overloaded()
+        for queue in self._queues.values():
+            for waiter in queue:
+                if not waiter.done():
+                    CALLS.inc(outcome="rejected")
+                    waiter.set_exception(error)
+        self._queues.clear()
+
+    def _record(self, error, probe):
+        if error is None:
+            CALLS.inc(outcome="ok")
+            self._failures = 0
+            # Only the probe may close the breaker: a call that was already
+            # in flight when it tripped says nothing about the API now.
+            if probe and self.breaker != CLOSED:
+                logger.info("Circuit breaker closed, calls are succeeding again")
+                self.breaker = CLOSED
+            if self.limit < self.max_concurrency:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                self._grant()
+            return
+        kind = error_kind(error)
+        CALLS.inc(outcome=kind or "error")
+        if kind is None:
+            return
+        now = time.monotonic()
+        # Only quota errors say we are sending too much; outages are left to
+        # retries and the breaker.
+        if kind == "rate_limited" and now - self._last_decrease >= DECREASE_INTERVAL:
+            self._last_decrease = now
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            logger.warning(f"API rate limited, concurrency limit down to {self.capacity}")
+        self._failures += 1
+        if probe or (self.breaker == CLOSED and self._failures >= BREAKER_FAILURES):
+            self._trip()
+
+    async def run(self, session_id, fn, *args, **kwargs):
+        """Runs `fn(*args, **kwargs)` on the pool once `session_id` gets a slot.
+
+        Raises ServiceOverloaded without calling `fn` while the circuit
+        breaker is open.
+        """
+        probe = self._admit()
+        queued_at = time.monotonic()
+        try:
+            await self._acquire(session_id)
+        except BaseException:
+            if probe:
+                self._probing = False
+            raise
+        self.total_wait_seconds += time.monotonic() - queued_at
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                self._executor, functools.partial(fn, *args, **kwargs))
+        except Exception as e:
+            self._record(e, probe)
+            raise
+        else:
+            self._record(None, probe)
+            return result
+        finally:
+            if probe:
+                self._probing = False
+            self.completed += 1
+            self._release()
+
+    async def run_with_retry(self, session_id, fn, *args, **kwargs):
+        """Like `run`, for idempotent calls: rate-limit and unavailable errors
+        are retried up to RETRY_ATTEMPTS times with full-jitter exponential
+        backoff. The slot is given up while waiting to retry."""
+        name = getattr(fn, '__name__', 'call')
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            try:
+                return await self.run(session_id, fn, *args, **kwargs)
+            except Exception as e:
+                if not is_transient(e) or attempt == RETRY_ATTEMPTS:
+                    raise
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                RETRIES.inc(call=name)
+                logger.warning(f"{name} failed ({str(e)}), retry {attempt} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            'max_concurrency': self.max_concurrency,
+            'limit': self.capacity,
+            'breaker': self.breaker,
+            'active': self.active,
+            'queue_depth': self.queue_depth,
+            'queued_sessions': len(self._queues),
+            'completed': self.completed,
+            'avg_wait_seconds': self.total_wait_seconds / self.completed if self.completed else 0.0,
+        }
+
+
+scheduler = RequestScheduler()
+
+registry.gauge("cyberinsight_scheduler_concurrency_limit",
+               "Current adaptive limit on concurrent API calls.",
+               lambda: scheduler.capacity)
+registry.gauge("cyberinsight_circuit_breaker_state",
+               "Circuit breaker state: 0 closed, 1 half-open, 2 open.",
+               lambda: _BREAKER_VALUES[scheduler.breaker])
@@ -0,0 +1,133 @@
+"""SQLite catalog of chat sessions.
+
+Keeps one row of metadata per session (title, report, activity, turn count)
+next to the history logs so listing and resuming chats never has to scan
+`chat_histories/`. Backfill it from existing histories with:
+
+$ python session_catalog.py rebuild
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import logging
+import threading
+
+import history_log
+
+logger = logging.getLogger(__name__)
+
+CATALOG_PATH = os.environ.get(
+    "SESSION_CATALOG_PATH", os.path.join(history_log.HISTORY_DIR, 'catalog.sqlite3'))
+TITLE_LENGTH = 80
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    title TEXT,
+    report_name TEXT,
+    report_hash TEXT,
+    created_at REAL NOT NULL,
+    last_activity REAL NOT NULL,
+    turn_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS sessions_by_activity ON sessions (last_activity DESC);
+CREATE INDEX IF NOT EXISTS sessions_by_report ON sessions (report_hash, last_activity DESC);
+"""
+
+
+def _title(user_message):
+    title = ' '.join(user_message.split())
+    return title if len(title) <= TITLE_LENGTH else title[:TITLE_LENGTH - 1] + '…'
+
+
+class SessionCatalog:
+    def __init__(self, path=CATALOG_PATH):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def record_turn(self, session_id, user_message, report_name=None, report_hash=None,
+                    at=None):
+        """Upserts a session after a completed turn."""
+        at = time.time() if at is None else at
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                INSERT INTO sessions (session_id, title, report_name, report_hash,
+                                      created_at, last_activity, turn_count)
+                VALUES (?, ?, ?, ?, ?, ?, 1)
+                ON CONFLICT (session_id) DO UPDATE SET
+                    title = COALESCE(title, excluded.title),
+                    report_name = COALESCE(excluded.report_name, report_name),
+                    report_hash = COALESCE(excluded.report_hash, report_hash),
+                    last_activity = excluded.last_activity,
+                    turn_count = turn_count + 1
+                """,
+                (session_id, _title(user_message), report_name, report_hash, at, at))
+
+    def get(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return dict(row) if row else None
+
+    def recent(self, limit=20, offset=0, report_hash=None):
+        """Most recently active sessions first, optionally for one report."""
+        query = "SELECT * FROM sessions"
+        params = []
+        if report_hash:
+            query += " WHERE report_hash = ?"
+            params.append(report_hash)
+        query += " ORDER BY last_activity DESC LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def delete(self, session_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def rebuild(self):
+        """Recreates the catalog from the logs in the history directory."""
+        rows = []
+        for session_id in history_log.list_sessions():
+            entries = history_log.read_entries(session_id)
+            user_turns = [entry for entry in entries if entry.get('role') == 'user']
+            if not user_turns:
+                continue
+            report = next((ref for entry in user_turns for ref in entry.get('files', [])), {})
+            path = history_log.log_path(session_id)
+            modified = os.path.getmtime(path) if os.path.exists(path) else time.time()
+            first_part = user_turns[0]['parts'][0] if user_turns[0]['parts'] else ''
+            rows.append((session_id, _title(str(first_part)), report.get('display_name'),
+                         report.get('digest'), modified, modified, len(user_turns)))
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions")
+            self._conn.executemany(
+                "INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        logger.info(f"Rebuilt session catalog with {len(rows)} sessions")
+        return len(rows)
+
+
+catalog = SessionCatalog()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python session_catalog.py rebuild")
+        sys.exit(2)
+    print(f"Catalogued {catalog.rebuild()} sessions in {catalog.path}")
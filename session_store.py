@@ -0,0 +1,127 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+MAX_SESSIONS = int(os.environ.get("SESSION_STORE_MAX_SESSIONS", "200"))
+MAX_BYTES = int(os.environ.get("SESSION_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", "1800"))
+
+EVICTIONS = registry.counter(
+    "cyberinsight_session_evictions",
+    "Chat sessions dropped from memory, by reason (idle, capacity, memory).",
+    ["reason"])
+REHYDRATIONS = registry.counter(
+    "cyberinsight_session_rehydrations",
+    "Evicted chat sessions rebuilt from their saved history.")
+
+
+def estimate_session_bytes(chat_session):
+    """Rough size of a ChatSession, dominated by the text in its history."""
+    size = 0
+    for content in chat_session.history:
+        for part in content.parts:
+            size += len(part.text) if part.text else 256
+    return size
+
+
+class SessionStore:
+    """LRU of live ChatSession objects bounded by count, size and idle time.
+
+    Evicted sessions are not lost: their history is on disk, and `get_or_load`
+    rebuilds them with the given loader the next time they are needed.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, max_bytes=MAX_BYTES, idle_ttl=IDLE_TTL):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.evictions = 0
+        self.rehydrations = 0
+        self._sessions = OrderedDict()
+        self._loading = {}
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def resident_bytes(self):
+        return sum(size for _, _, size in self._sessions.values())
+
+    def _evict(self, session_id, reason):
+        del self._sessions[session_id]
+        self.evictions += 1
+        EVICTIONS.inc(reason=reason)
+        logger.info(f"Evicted chat session {session_id} ({reason})")
+
+    def _enforce_limits(self):
+        now = time.monotonic()
+        for session_id, (_, last_used, _) in list(self._sessions.items()):
+            if now - last_used > self.idle_ttl:
+                self._evict(session_id, "idle")
+        while len(self._sessions) > self.max_sessions:
+            self._evict(next(iter(self._sessions)), "capacity")
+        while len(self._sessions) > 1 and self.resident_bytes > self.max_bytes:
+            self._evict(next(iter(self._sessions)), "memory")
+
+    def get(self, session_id):
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        self.touch(session_id)
+        return entry[0]
+
+    def put(self, session_id, chat_session):
+        self._sessions[session_id] = (
+            chat_session, time.monotonic(), estimate_session_bytes(chat_session))
+        self._sessions.move_to_end(session_id)
+        self._enforce_limits()
+
+    def touch(self, session_id):
+        """Marks a session as just used and re-measures it after a turn."""
+        entry = self._sessions.get(session_id)
+        if entry is not None:
+            self.put(session_id, entry[0])
+
+    def pop(self, session_id, default=None):
+        entry = self._sessions.pop(session_id, None)
+        return default if entry is None else entry[0]
+
+    async def get_or_load(self, session_id, loader):
+        """Returns the live session, rebuilding it with `loader` if evicted."""
+        chat_session = self.get(session_id)
+        if chat_session is not None:
+            return chat_session
+        # Concurrent messages for the same session share one rehydration.
+        task = self._loading.get(session_id)
+        if task is None:
+            task = asyncio.ensure_future(loader(session_id))
+            self._loading[session_id] = task
+            try:
+                chat_session = await task
+            finally:
+                del self._loading[session_id]
+            self.rehydrations += 1
+            REHYDRATIONS.inc()
+            self.put(session_id, chat_session)
+            logger.info(f"Rehydrated chat session {session_id} from history")
+            return chat_session
+        return await task
+
+    def stats(self):
+        return {
+            'resident': len(self._sessions),
+            'resident_bytes': self.resident_bytes,
+            'evictions': self.evictions,
+            'rehydrations': self.rehydrations,
+            'max_sessions': self.max_sessions,
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+COALESCED = registry.counter(
+    "cyberinsight_coalesced_requests",
+    "Calls that joined an identical call already in flight instead of running their own.",
+    ["kind"])
+
+
+class WaitStopped(Exception):
+    """A caller's stop_event was set while it waited for a shared call."""
+
+
+class _Call:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs concurrent calls with the same key once and shares the result.
+
+    The first caller for a key starts the work as its own task; callers that
+    arrive while it runs wait on that task instead of starting another. A
+    waiter that is cancelled (the user stopped or disconnected) only stops
+    waiting; the work itself is cancelled once nobody is waiting for it.
+    Results are not kept after the call finishes, caching is left to the
+    caller.
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.coalesced = 0
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key, fn, stop_event=None):
+        """Returns (result, shared). `fn` is a zero-argument coroutine
+        function, only called if no call for `key` is in flight. `shared` is
+        True if this caller joined another caller's call. Setting
+        `stop_event` stops this caller's wait with WaitStopped."""
+        call = self._calls.get(key)
+        shared = call is not None
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            self.coalesced += 1
+            COALESCED.inc(kind=self.kind)
+            logger.info(f"Joined in-flight {self.kind} call ({self.coalesced} coalesced so far)")
+        call.waiters += 1
+        try:
+            if stop_event is None:
+                result = await asyncio.shield(call.task)
+            else:
+                result = await self._wait_or_stop(call.task, stop_event)
+        except (asyncio.CancelledError, WaitStopped):
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                logger.info(f"Last waiter left, cancelling {self.kind} call")
+                call.task.cancel()
+            raise
+        call.waiters -= 1
+        return result, shared
+
+    @staticmethod
+    async def _wait_or_stop(task, stop_event):
+        stopper = asyncio.ensure_future(stop_event.wait())
+        try:
+            await asyncio.wait([task, stopper], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopper.cancel()
+        if not task.done():
+            raise WaitStopped("Stopped while waiting for a shared call")
+        return task.result()
@@ -0,0 +1,98 @@
+"""Cold-start check for the app modules.
+
+$ python startup_check.py --target 5
+
+Imports each app module in a fresh interpreter, without GEMINI_API_KEY in
+the environment, and reports how long the import took. Importing must not
+need the key, touch the network or build models, so a slow or failing
+import here means a side effect has crept back in. Exits non-zero if any
+module fails to import or its median import time is above the target.
+Use --profile to list the slowest imports of each module.
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+MODULES = ["app", "app_v2", "frontend", "batch", "ai"]
+TARGET_SECONDS = float(os.environ.get("STARTUP_TARGET_SECONDS", "5"))
+
+_PROBE = """
+import sys, json, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+import {module}
+print(json.dumps({{'import_s': time.perf_counter() - started}}))
+"""
+
+
+def child_env():
+    env = dict(os.environ)
+    # Importing must not need the key; the client reads it on first use.
+    env.pop("GEMINI_API_KEY", None)
+    env.setdefault("METRICS_PORT", "0")
+    return env
+
+
+def measure(module, root):
+    result = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(root=root, module=module)],
+        capture_output=True, text=True, env=child_env())
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"
+    return json.loads(result.stdout.strip().splitlines()[-1])['import_s'], None
+
+
+def slowest_imports(module, root, count=10):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {root!r}); import {module}"],
+        capture_output=True, text=True, env=child_env())
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = (field.strip() for field in line[len("import time:"):].split("|"))
+        if cumulative.isdigit():
+            rows.append((int(cumulative), name))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cold-start import time of the app modules.")
+    parser.add_argument("modules", nargs="*", default=MODULES, help="modules to import (default: all apps)")
+    parser.add_argument("--target", type=float, default=TARGET_SECONDS,
+                        help=f"maximum median import time in seconds (default: {TARGET_SECONDS:g})")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh imports per module (default: 3)")
+    parser.add_argument("--profile", action="store_true", help="list the slowest imports of each module")
+    args = parser.parse_args(argv)
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    failed = False
+    for module in args.modules:
+        samples = []
+        error = None
+        for _ in range(args.repeat):
+            seconds, error = measure(module, root)
+            if error:
+                break
+            samples.append(seconds)
+        if error:
+            failed = True
+            print(f"{module:10} FAILED  {error}")
+            continue
+        median = statistics.median(samples)
+        over = median > args.target
+        failed = failed or over
+        print(f"{module:10} {'OVER' if over else 'ok':6}  median {median:.2f}s, "
+              f"min {min(samples):.2f}s, max {max(samples):.2f}s (target {args.target:g}s)")
+        if args.profile:
+            for cumulative, name in slowest_imports(module, root):
+                print(f"{'':12}{cumulative / 1e6:6.2f}s  {name}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
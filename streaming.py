@@ -0,0 +1,86 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+
+from scheduler import scheduler
+from metrics import TIME_TO_FIRST_TOKEN, record_usage
+
+logger = logging.getLogger(__name__)
+
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+
+_DONE = object()
+
+
+def _chunk_text(chunk):
+    # The final chunk of a stream can carry only the finish reason and no
+    # parts, in which case `.text` raises.
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+async def stream_response(chat_session, content, reply, session_id=None):
+    """Sends `content` on `chat_session` and streams the answer into `reply`.
+
+    The blocking SDK iterator is drained on a scheduler thread, holding one of
+    `session_id`'s slots for the whole stream, and tokens are handed back to
+    the event loop through a queue. Returns the full text once the stream
+    completes.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+    model_name = getattr(chat_session.model, 'model_name', '')
+
+    def produce():
+        response = chat_session.send_message(content, stream=True)
+        for chunk in response:
+            if stopped.is_set():
+                break
+            loop.call_soon_threadsafe(queue.put_nowait, _chunk_text(chunk))
+        else:
+            # Usage metadata is only complete once the stream is drained.
+            record_usage(getattr(response, 'usage_metadata', None), model_name)
+        loop.call_soon_threadsafe(queue.put_nowait, _DONE)
+
+    def forward_error(task):
+        # Errors are raised through the scheduler, which adapts to them, and
+        # then handed to the consumer. That includes the scheduler turning
+        # the call away before `produce` ever ran.
+        if not task.cancelled() and task.exception() is not None:
+            queue.put_nowait(task.exception())
+
+    started = time.monotonic()
+    first_token_at = None
+    producer = asyncio.create_task(scheduler.run(session_id, produce))
+    producer.add_done_callback(forward_error)
+    parts = []
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                continue
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+                TIME_TO_FIRST_TOKEN.observe(first_token_at - started, model=model_name)
+                logger.info(f"Time to first token: {first_token_at - started:.2f}s")
+            parts.append(item)
+            await reply.stream_token(item)
+    except BaseException:
+        stopped.set()
+        # A stream that broke half way leaves the chat unusable until the
+        # incomplete exchange is dropped.
+        if chat_session.last is not None:
+            chat_session.rewind()
+        raise
+    await producer
+    logger.info(f"Streamed response in {time.monotonic() - started:.2f}s")
+    return "".join(parts)
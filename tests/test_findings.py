@@ -0,0 +1,91 @@
+import pytest
+
+import findings
+from findings import Finding
+
+RECORDS = [
+    Finding('1', 'Patching', 1, 'High', page=4),
+    Finding('2', 'Backups', 2, 'Medium', page=5),
+    Finding('3', 'Awareness training', 3, 'Low', page=5),
+    Finding('Issue 4', 'Privileged access', 1, 'Critical', recommendation='Review admin accounts', page=7),
+]
+
+
+def ids(question):
+    return [finding.id for finding in findings.run_query(RECORDS, findings.parse_query(question))]
+
+
+@pytest.mark.parametrize("question", [
+    "Which issues relate to the firewall?",
+    "list the findings about passwords",
+    "What are the risks of the firewall rules issue?",
+    "sort the findings by owner",
+    "list findings by title",
+    "list all findings in order of owner",
+    "Summarize the priority 1 findings",
+    "list findings from 2023",
+    "list the low priority findings",
+    "which findings about access are rated high?",
+])
+def test_questions_the_parser_cannot_fully_read_go_to_the_model(question):
+    assert findings.parse_query(question) is None
+
+
+def test_in_order_of_sorts():
+    query = findings.parse_query("list all findings in order of severity")
+    assert query.sort_by == 'severity'
+
+
+def test_sorted_by_deadline_adds_the_column():
+    query = findings.parse_query("list findings sorted by deadline")
+    assert query.sort_by == 'deadline'
+    assert 'deadline' in query.columns
+
+
+def test_priority_filter():
+    query = findings.parse_query("Which findings are priority 1 or 2?")
+    assert query.priorities == [1, 2]
+    assert query.sort_by is None
+
+
+def test_top_n_by_severity():
+    query = findings.parse_query("show me the top 3 findings by severity")
+    assert (query.limit, query.sort_by) == (3, 'severity')
+
+
+def test_count_of_severity():
+    query = findings.parse_query("How many high severity findings are there?")
+    assert query.count and query.severities == ['high']
+
+
+def test_columns_and_output():
+    query = findings.parse_query("give me the recommendations and responsible officers as csv")
+    assert query.output == 'csv'
+    assert query.columns[-2:] == ['recommendation', 'owner']
+
+
+def test_finding_by_id():
+    assert ids("show finding 3") == ['3']
+
+
+def test_recommendation_for_an_issue():
+    query = findings.parse_query("show the recommendation for issue 4")
+    assert 'recommendation' in query.columns
+    assert ids("show the recommendation for issue 4") == ['Issue 4']
+
+
+def test_page_filter():
+    assert ids("list findings on page 5") == ['2', '3']
+    assert ids("list findings on pages 4 to 5") == ['1', '2', '3']
+
+
+def test_rated_level():
+    assert ids("which findings are rated high?") == ['1']
+
+
+def test_list_of_severities():
+    assert ids("show me all high and medium findings") == ['1', '2']
+
+
+def test_number_of_findings_limits():
+    assert len(ids("list 3 findings")) == 3
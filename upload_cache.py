@@ -0,0 +1,138 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone, timedelta
+
+from model_client import client
+from scheduler import is_transient
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.environ.get(
+    "UPLOAD_CACHE_PATH", os.path.join("cache", "uploads.json"))
+# Treat handles as expired a little early so a conversation does not start
+# on a file that disappears half way through.
+EXPIRY_MARGIN = timedelta(
+    seconds=int(os.environ.get("UPLOAD_CACHE_EXPIRY_MARGIN", "600")))
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _to_iso(value):
+    # An unset proto timestamp comes back as the epoch rather than None.
+    if value is None or value.year <= 1970:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.isoformat()
+
+
+class UploadCache:
+    """Maps the SHA-256 of a local file to the Gemini file it was uploaded as.
+
+    Entries are persisted to a small JSON file so the same report is only
+    uploaded once across sessions and restarts, for as long as the remote
+    handle lives.
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable upload cache {self.path}: {str(e)}")
+            return {}
+
+    def _save(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self._entries, file)
+        os.replace(tmp_path, self.path)
+
+    def _evict(self, digest, reason):
+        with self._lock:
+            if self._entries.pop(digest, None) is not None:
+                self.evictions += 1
+                self._save()
+        logger.info(f"Evicted upload cache entry {digest[:12]}: {reason}")
+
+    def _expired(self, entry):
+        expires_at = entry.get('expiration_time')
+        if not expires_at:
+            return False
+        expires_at = datetime.fromisoformat(expires_at)
+        return expires_at - EXPIRY_MARGIN <= datetime.now(timezone.utc)
+
+    def lookup(self, digest):
+        """Returns the live, ACTIVE remote file for `digest`, or None."""
+        with self._lock:
+            entry = self._entries.get(digest)
+        if entry is None:
+            self.misses += 1
+            return None
+        if self._expired(entry):
+            self._evict(digest, "expired")
+            self.misses += 1
+            return None
+        try:
+            file = client.get_file(entry['name'])
+        except Exception as e:
+            if is_transient(e):
+                # Says nothing about the file; let the caller retry.
+                raise
+            self._evict(digest, f"remote file gone ({str(e)})")
+            self.misses += 1
+            return None
+        if file.state.name != "ACTIVE":
+            self._evict(digest, f"remote file is {file.state.name}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        logger.info(f"Upload cache hit for {digest[:12]}: {file.name}")
+        return file
+
+    def store(self, digest, file):
+        with self._lock:
+            self._entries[digest] = {
+                'name': file.name,
+                'uri': file.uri,
+                'display_name': file.display_name,
+                'mime_type': file.mime_type,
+                'expiration_time': _to_iso(getattr(file, 'expiration_time', None)),
+                'cached_at': datetime.now(timezone.utc).isoformat(),
+            }
+            self._save()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+upload_cache = UploadCache()